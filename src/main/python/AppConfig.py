@@ -7,9 +7,12 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtSql import QSqlTableModel
 from PyQt5.QtWidgets import (QCheckBox, QComboBox, QDialog, QDialogButtonBox, QFileDialog, QFormLayout, QGroupBox,
                              QHBoxLayout, QLabel, QLineEdit, QMessageBox,
-                             QPushButton, QRadioButton, QStackedLayout, QStackedWidget, QTabWidget, QTextEdit, QVBoxLayout, QWidget)
+                             QPushButton, QRadioButton, QSpinBox, QStackedLayout, QStackedWidget, QTabWidget, QTextEdit, QVBoxLayout, QWidget)
 
 from db import create_patients_table
+from dicom_loader import default_workers
+from series import DEFAULT_CACHE_MB, DEFAULT_PREFETCH
+from series_cache import DEFAULT_DISK_CACHE_MB
 
 
 class AppConfig(QDialog):
@@ -35,6 +38,7 @@ class AppConfig(QDialog):
     self.layout.addWidget(self.buttons)
 
     self.patients_db.setText(os.path.abspath(self.configs['patients_db']))
+    self.set_perf_fields()
     self.setLayout(self.layout)
     self.resize(400, 300)
 
@@ -44,6 +48,7 @@ class AppConfig(QDialog):
     self.buttons.rejected.connect(self.on_cancel)
     self.open_db.clicked.connect(self.on_open)
     self.add_scanner_btn.clicked.connect(self.on_scanner_data)
+    self.clear_cache_btn.clicked.connect(self.on_clear_cache)
 
   def setTabs(self):
     self.db_tab = QWidget()
@@ -74,8 +79,77 @@ class AppConfig(QDialog):
     self.db_tab.setLayout(grid)
     self.tabs.addTab(self.db_tab, 'Database')
 
+    self.perf_tab = QWidget()
+    perf_grid = QVBoxLayout()
+
+    self.workers_sb = QSpinBox()
+    self.workers_sb.setRange(1, max(os.cpu_count() or 1, default_workers()))
+    self.workers_sb.setToolTip('Number of parallel workers used to read and decode DICOM files')
+
+    self.cache_sb = QSpinBox()
+    self.cache_sb.setRange(0, 65536)
+    self.cache_sb.setSingleStep(64)
+    self.cache_sb.setSuffix(' MB')
+    self.cache_sb.setToolTip('Memory budget for decoded slices kept in memory')
+
+    self.prefetch_sb = QSpinBox()
+    self.prefetch_sb.setRange(0, 64)
+    self.prefetch_sb.setToolTip('Number of neighbouring slices decoded in the background while scrolling')
+
+    self.volume_chk = QCheckBox('Memory-mapped volume')
+    self.volume_chk.setToolTip('Convert each opened series into a memory-mapped HU volume on disk,\nkeeping memory use flat for very long series')
+
+    self.stream_chk = QCheckBox('Show first image while loading')
+    self.stream_chk.setToolTip('Display the series as soon as its first image is read and load the rest in the background.\nCalculations are available once loading is complete.')
+
+    loader_grpbox = QGroupBox('Image Loading:')
+    loader_form = QFormLayout()
+    loader_form.addRow(QLabel('Workers'), self.workers_sb)
+    loader_form.addRow(QLabel('Slice cache'), self.cache_sb)
+    loader_form.addRow(QLabel('Prefetch slices'), self.prefetch_sb)
+    loader_form.addRow(QLabel(''), self.stream_chk)
+    loader_form.addRow(QLabel(''), self.volume_chk)
+    loader_grpbox.setLayout(loader_form)
+
+    self.disk_cache_sb = QSpinBox()
+    self.disk_cache_sb.setRange(0, 1048576)
+    self.disk_cache_sb.setSingleStep(256)
+    self.disk_cache_sb.setSuffix(' MB')
+    self.disk_cache_sb.setToolTip('Disk space for decoded series kept for reopening, 0 disables the cache.\nWhen enabled, a series is decoded in full the first time it is opened.')
+    self.disk_cache_lbl = QLabel()
+    self.clear_cache_btn = QPushButton('Clear Cache')
+
+    cache_grpbox = QGroupBox('Series Cache:')
+    cache_form = QFormLayout()
+    cache_form.addRow(QLabel('Maximum size'), self.disk_cache_sb)
+    h3 = QHBoxLayout()
+    h3.addWidget(self.disk_cache_lbl)
+    h3.addStretch()
+    h3.addWidget(self.clear_cache_btn)
+    cache_form.addRow(QLabel('In use'), h3)
+    cache_grpbox.setLayout(cache_form)
+
+    perf_grid.addWidget(loader_grpbox)
+    perf_grid.addWidget(cache_grpbox)
+    perf_grid.addStretch()
+
+    self.perf_tab.setLayout(perf_grid)
+    self.tabs.addTab(self.perf_tab, 'Performance')
+
     self.setConnect()
 
+  def set_perf_fields(self):
+    self.workers_sb.setValue(self.configs.get('loader_workers', default_workers()))
+    self.cache_sb.setValue(self.configs.get('hu_cache_mb', DEFAULT_CACHE_MB))
+    self.prefetch_sb.setValue(self.configs.get('prefetch_slices', DEFAULT_PREFETCH))
+    self.stream_chk.setChecked(self.configs.get('stream_load', True))
+    self.volume_chk.setChecked(self.configs.get('use_volume', False))
+    self.disk_cache_sb.setValue(self.configs.get('disk_cache_mb', DEFAULT_DISK_CACHE_MB))
+    self.update_cache_usage()
+
+  def update_cache_usage(self):
+    self.disk_cache_lbl.setText(f'{self.ctx.series_cache.size()/2**20:#.1f} MB')
+
   def _get_config(self):
     with open(self.ctx.config_file(), 'r') as f:
       return json.load(f)
@@ -87,6 +161,12 @@ class AppConfig(QDialog):
   def _set_default(self):
     self.configs = {
       'patients_db': self.ctx.default_patients_database,
+      'loader_workers': default_workers(),
+      'hu_cache_mb': DEFAULT_CACHE_MB,
+      'prefetch_slices': DEFAULT_PREFETCH,
+      'stream_load': True,
+      'use_volume': False,
+      'disk_cache_mb': DEFAULT_DISK_CACHE_MB,
     }
     self._set_config()
     if not os.path.exists(self.configs['patients_db']):
@@ -96,6 +176,7 @@ class AppConfig(QDialog):
         self.ctx.ioError()
         return
     self.patients_db.setText(os.path.abspath(self.configs['patients_db']))
+    self.set_perf_fields()
 
   def on_scanner_data(self):
     QMessageBox.information(None, "Not yet implemented", "This feature is not fully implemented yet.")
@@ -103,12 +184,25 @@ class AppConfig(QDialog):
 
   def on_save(self):
     self.configs['patients_db'] = os.path.abspath(self.patients_db.text())
+    self.configs['loader_workers'] = self.workers_sb.value()
+    self.configs['hu_cache_mb'] = self.cache_sb.value()
+    self.configs['prefetch_slices'] = self.prefetch_sb.value()
+    self.configs['stream_load'] = self.stream_chk.isChecked()
+    self.configs['use_volume'] = self.volume_chk.isChecked()
+    self.configs['disk_cache_mb'] = self.disk_cache_sb.value()
     self._set_config()
 
     if not os.path.isfile(self.configs['patients_db']):
       create_patients_table(self.configs['patients_db'])
     self.accept()
 
+  def on_clear_cache(self):
+    btn_reply = QMessageBox.question(self, 'Clear Cache', 'Remove all cached series?')
+    if btn_reply == QMessageBox.No:
+      return
+    self.ctx.series_cache.clear()
+    self.update_cache_usage()
+
   def on_open(self):
     filename, _ = QFileDialog.getSaveFileName(self, "Select Database File", os.path.join(self.configs['patients_db'], os.pardir), "Database (*.db)")
     print(filename)
@@ -125,6 +219,7 @@ class AppConfig(QDialog):
 
   def on_cancel(self):
     self.patients_db.setText(os.path.abspath(self.configs['patients_db']))
+    self.set_perf_fields()
     self.reject()
 
 class ScannerDataDialog(QDialog):
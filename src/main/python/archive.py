@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+# files inside an archive are named '<archive path>::<member name>' so they
+# can be passed around like ordinary file names
+SEP = '::'
+ZIP_EXTS = ('.zip',)
+TAR_EXTS = ('.tar',)
+COMPRESSED_TAR_EXTS = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+_lock = threading.Lock()
+_handles = {} # (archive, thread id) -> open ZipFile/TarFile
+_extracted = {} # compressed tar archive -> (temp dir, {member name: extracted file})
+
+
+def is_archive(path):
+  return path.lower().endswith(ZIP_EXTS + TAR_EXTS + COMPRESSED_TAR_EXTS)
+
+def member_path(path, name):
+  return path + SEP + name
+
+def split_member(fname):
+  # (archive, member name) of an archive member, None for ordinary files
+  if not isinstance(fname, str) or SEP not in fname:
+    return None
+  path, name = fname.split(SEP, 1)
+  return (path, name) if is_archive(path) else None
+
+def is_member(fname):
+  return split_member(fname) is not None
+
+def source_path(fname):
+  # the file on disk that holds fname
+  member = split_member(fname)
+  return member[0] if member else fname
+
+def list_members(path):
+  if path.lower().endswith(ZIP_EXTS):
+    with zipfile.ZipFile(path) as zf:
+      names = [info.filename for info in zf.infolist() if not info.is_dir()]
+  elif path.lower().endswith(TAR_EXTS):
+    with tarfile.open(path) as tf:
+      names = [m.name for m in tf if m.isfile()]
+  else:
+    names = list(_extract_compressed(path))
+  return [member_path(path, name) for name in sorted(names)]
+
+def read_member(fname, size=-1):
+  # bytes of an archive member, the first size bytes when size >= 0
+  path, name = split_member(fname)
+  if path.lower().endswith(COMPRESSED_TAR_EXTS):
+    with open(_extract_compressed(path)[name], 'rb') as f:
+      return f.read(size)
+  handle = _get_handle(path)
+  if isinstance(handle, zipfile.ZipFile):
+    with handle.open(name) as f:
+      return f.read(size)
+  f = handle.extractfile(name)
+  if f is None:
+    raise OSError(f'{fname} is not a file')
+  return f.read(size)
+
+def open_source(fname):
+  # fname itself for ordinary files, the extracted file for members of
+  # compressed tar archives and a file-like object for other members
+  member = split_member(fname)
+  if member is None:
+    return fname
+  if member[0].lower().endswith(COMPRESSED_TAR_EXTS):
+    return _extract_compressed(member[0])[member[1]]
+  return io.BytesIO(read_member(fname))
+
+def close_all():
+  with _lock:
+    for handle in _handles.values():
+      handle.close()
+    _handles.clear()
+    for tmp, _ in _extracted.values():
+      shutil.rmtree(tmp, ignore_errors=True)
+    _extracted.clear()
+
+def _get_handle(path):
+  # zip and plain tar archives allow random access, every thread reads them
+  # through its own handle so members can be read in parallel
+  key = (path, threading.get_ident())
+  with _lock:
+    handle = _handles.get(key)
+  if handle is None:
+    handle = zipfile.ZipFile(path) if path.lower().endswith(ZIP_EXTS) else tarfile.open(path)
+    with _lock:
+      _handles[key] = handle
+  return handle
+
+def _extract_compressed(path):
+  # compressed tar streams cannot be read at random, their members are
+  # extracted once in order to a temporary directory, removed by close_all.
+  # the extracted files are numbered, member names are never used as paths.
+  with _lock:
+    if path not in _extracted:
+      tmp = tempfile.mkdtemp(prefix='indosect-')
+      files = {}
+      try:
+        with tarfile.open(path, 'r:*') as tf:
+          for m in tf:
+            if m.isfile():
+              dst = os.path.join(tmp, str(len(files)))
+              with tf.extractfile(m) as src, open(dst, 'wb') as f:
+                shutil.copyfileobj(src, f)
+              files[m.name] = dst
+      except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+      _extracted[path] = (tmp, files)
+    return _extracted[path][1]
@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from pydicom.uid import generate_uid
+
+from image_processing import get_dicom
+
+# what the export does to the header of every file: 'remove' drops the
+# elements, 'replace' gives new values to the elements present, 'remove_private'
+# drops private tags and 'remap_uids' replaces the instance UIDs with new ones
+# that keep the study/series structure. the 'deid_profile' config entry
+# overrides any of these. pixel data is copied as it is.
+DEFAULT_PROFILE = {
+  'remove': [
+    'PatientBirthDate', 'PatientBirthTime', 'PatientAddress',
+    'PatientTelephoneNumbers', 'PatientMotherBirthName', 'OtherPatientIDs',
+    'OtherPatientNames', 'OtherPatientIDsSequence', 'MilitaryRank',
+    'EthnicGroup', 'Occupation', 'AdditionalPatientHistory', 'PatientComments',
+    'ReferringPhysicianName', 'ReferringPhysicianAddress',
+    'ReferringPhysicianTelephoneNumbers', 'PerformingPhysicianName',
+    'NameOfPhysiciansReadingStudy', 'PhysiciansOfRecord', 'RequestingPhysician',
+    'OperatorsName', 'InstitutionName', 'InstitutionAddress',
+    'InstitutionalDepartmentName', 'StationName', 'DeviceSerialNumber',
+    'AccessionNumber', 'StudyID', 'RequestAttributesSequence',
+  ],
+  'replace': {
+    'PatientName': 'ANONYMOUS',
+    'PatientID': 'ANONYMOUS',
+  },
+  'remove_private': True,
+  'remap_uids': True,
+}
+UID_TAGS = ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID',
+            'FrameOfReferenceUID', 'ReferencedSOPInstanceUID',
+            'MediaStorageSOPInstanceUID']
+
+
+def get_profile(custom=None):
+  profile = dict(DEFAULT_PROFILE)
+  profile.update(custom or {})
+  return profile
+
+def new_uid(uid, salt):
+  # the same uid gets the same replacement within one export, so files of
+  # a series stay together without sharing a lookup table between workers
+  return generate_uid(entropy_srcs=[salt, str(uid)])
+
+def anonymize(ds, profile, salt):
+  # edits the header of ds in place, nested sequences included
+  remove = set(profile['remove'])
+  replace = profile['replace']
+  uids = set(UID_TAGS) if profile['remap_uids'] else set()
+
+  def clean(dataset, elem):
+    if elem.keyword in remove:
+      del dataset[elem.tag]
+    elif elem.keyword in replace:
+      elem.value = replace[elem.keyword]
+    elif elem.keyword in uids and elem.value:
+      elem.value = new_uid(elem.value, salt)
+
+  if profile['remove_private']:
+    ds.remove_private_tags()
+  ds.walk(clean)
+  meta = getattr(ds, 'file_meta', None)
+  if meta is not None and uids and 'MediaStorageSOPInstanceUID' in meta:
+    meta.MediaStorageSOPInstanceUID = new_uid(meta.MediaStorageSOPInstanceUID, salt)
+  ds.PatientIdentityRemoved = 'YES'
+  return ds
+
+def export_file(src, dst, profile, salt):
+  # PixelData is read and written back as raw bytes, it is never decoded
+  try:
+    ds = get_dicom(src)
+    anonymize(ds, profile, salt)
+    ds.save_as(dst)
+    return True
+  except Exception:
+    try:
+      os.remove(dst)
+    except OSError:
+      pass
+    return False
+
+def export_series(executor, fnames, out_dir, profile, ahead=8, callback=None):
+  # writes anonymized copies of fnames to out_dir as IMG00001.dcm, ... with
+  # at most ahead files being read or written at once. callback(count)
+  # returns False to cancel. returns (written, failed).
+  salt = os.urandom(16).hex()
+  jobs = iter(enumerate(fnames))
+  pending = set()
+  written = failed = 0
+  while True:
+    for idx, fname in jobs:
+      dst = os.path.join(out_dir, f'IMG{idx+1:05d}.dcm')
+      pending.add(executor.submit(export_file, fname, dst, profile, salt))
+      if len(pending) >= ahead:
+        break
+    if not pending:
+      break
+    done, pending = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+    for fut in done:
+      if fut.result():
+        written += 1
+      else:
+        failed += 1
+    if callback is not None and not callback(written + failed):
+      for fut in pending:
+        fut.cancel()
+      wait(pending)
+      break
+  return written, failed
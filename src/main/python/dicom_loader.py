@@ -0,0 +1,261 @@
+import os
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+import pydicom.config
+
+from archive import is_member, list_members, read_member
+from image_processing import get_dicom, get_hu_frames, get_hu_img
+from multiframe import (FG_SEQUENCES, is_enhanced, is_multiframe,
+                        split_frames)
+from slice_record import RECORD_TAGS, SliceRecord
+
+# tags read from each file: the values kept in the slice records, and what is
+# needed to check the pixel data can be decoded and to split multi-frame
+# images. everything else is re-read from the file on demand (e.g. for the
+# DICOM tree view).
+HEADER_TAGS = RECORD_TAGS + [
+  'SamplesPerPixel', 'PhotometricInterpretation', 'BitsAllocated', 'BitsStored',
+  'HighBit', 'PixelRepresentation', 'NumberOfFrames',
+] + FG_SEQUENCES
+REQUIRED_TAGS = ['Rows', 'Columns', 'BitsAllocated', 'PixelRepresentation',
+                 'RescaleIntercept', 'RescaleSlope']
+
+
+DICM_OFFSET = 128
+
+
+def default_workers():
+  return max(1, min(4, os.cpu_count() or 1))
+
+def can_decode(ds):
+  if not all(tag in ds for tag in REQUIRED_TAGS):
+    return False
+  tsyntax = ds.file_meta.TransferSyntaxUID
+  return any(h.supports_transfer_syntax(tsyntax) and h.is_available()
+             for h in pydicom.config.pixel_data_handlers)
+
+def is_dicom_file(fname):
+  # DICOM part 10 files have a 128 byte preamble followed by 'DICM'. files
+  # without it are accepted when they start with a group 0x0008 tag, which
+  # get_dicom can still read by force.
+  try:
+    if is_member(fname):
+      head = read_member(fname, DICM_OFFSET + 4)
+    else:
+      with open(fname, 'rb') as f:
+        head = f.read(DICM_OFFSET + 4)
+  except Exception:
+    return False
+  if head[DICM_OFFSET:DICM_OFFSET+4] == b'DICM':
+    return True
+  return head[:2] == b'\x08\x00'
+
+def walk_files(root):
+  stack = [root]
+  while stack:
+    try:
+      entries = os.scandir(stack.pop())
+    except OSError:
+      continue
+    with entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          stack.append(entry.path)
+        elif entry.is_file():
+          yield entry.path
+
+def series_uid(ds):
+  return ds.get('StudyInstanceUID'), ds.get('SeriesInstanceUID')
+
+def group_series(dicoms):
+  # groups datasets by study and series, in the order each series is first seen
+  groups = {}
+  for ds in dicoms:
+    groups.setdefault(series_uid(ds), []).append(ds)
+  return list(groups.values())
+
+def instance_key(ds):
+  uid = ds.get('SOPInstanceUID')
+  return None if uid is None else (str(uid), getattr(ds, 'frame', None))
+
+def drop_duplicates(dicoms, seen=None):
+  # keeps the first header of every instance (or frame of an instance).
+  # seen carries the instances already kept across calls. returns the kept
+  # headers and the number dropped.
+  seen = set() if seen is None else seen
+  unique = []
+  for ds in dicoms:
+    key = instance_key(ds)
+    if key is not None:
+      if key in seen:
+        continue
+      seen.add(key)
+    unique.append(ds)
+  return unique, len(dicoms) - len(unique)
+
+def read_header(fname):
+  # slice records of fname, one per frame for multi-frame and enhanced
+  # images. None when the file cannot be used.
+  try:
+    ds = get_dicom(fname, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    headers = split_frames(ds) if is_multiframe(ds) or is_enhanced(ds) else [ds]
+    if not can_decode(headers[0]):
+      return None
+    return [SliceRecord.from_dataset(header) for header in headers]
+  except Exception:
+    return None
+
+def decode_file(fname):
+  try:
+    return get_hu_img(get_dicom(fname))
+  except Exception:
+    return None
+
+def decode_frames(fname):
+  try:
+    return get_hu_frames(get_dicom(fname))
+  except Exception:
+    return None
+
+
+class HeaderStream:
+  # header reads running in a thread pool. poll() hands out the results in
+  # the order of the files, up to the first file that is still being read.
+  def __init__(self, executor, fnames):
+    self.total = len(fnames)
+    self.count = 0
+    self.discarded = 0
+    self.duplicates = 0
+    self._seen = set()
+    self._futures = [executor.submit(read_header, fname) for fname in fnames]
+
+  def done(self):
+    return self.count == self.total
+
+  def poll(self):
+    headers = []
+    while self.count < self.total and self._futures[self.count].done():
+      res = self._futures[self.count].result()
+      self._futures[self.count] = None
+      self.count += 1
+      if res is None:
+        self.discarded += 1
+        continue
+      res, dup = drop_duplicates(res, self._seen)
+      self.duplicates += dup
+      headers += res
+    return headers
+
+  def cancel(self):
+    for fut in self._futures[self.count:]:
+      fut.cancel()
+
+
+class DicomLoader:
+  def __init__(self, workers=None):
+    self.workers = workers or default_workers()
+    self._threads = None
+    self._procs = None
+
+  @property
+  def threads(self):
+    if self._threads is None:
+      self._threads = ThreadPoolExecutor(max_workers=self.workers)
+    return self._threads
+
+  @property
+  def procs(self):
+    if self._procs is None:
+      self._procs = ProcessPoolExecutor(max_workers=self.workers)
+    return self._procs
+
+  def shutdown(self):
+    if self._threads is not None:
+      self._threads.shutdown(wait=False)
+    if self._procs is not None:
+      self._procs.shutdown(wait=False)
+    self._threads = self._procs = None
+
+  def scan(self, root):
+    # recursive list of the files under root that look like DICOM
+    return self._sniff(sorted(walk_files(root)))
+
+  def scan_archive(self, path):
+    # members of a zip/tar archive that look like DICOM
+    return self._sniff(list_members(path))
+
+  def _sniff(self, fnames):
+    if self.workers <= 1:
+      found = [is_dicom_file(fname) for fname in fnames]
+    else:
+      found = list(self.threads.map(is_dicom_file, fnames))
+    return [fname for fname, ok in zip(fnames, found) if ok]
+
+  def load(self, fnames, callback=None):
+    # reads header records only, pixel data is decoded on demand. results
+    # keep the order of fnames, repeated instances are dropped. returns
+    # (headers, discarded files, duplicates). callback(count) returns False
+    # to cancel.
+    n = len(fnames)
+    headers = [None]*n
+    finished = [False]*n
+    if self.workers <= 1:
+      for idx, fname in enumerate(fnames):
+        headers[idx] = read_header(fname)
+        finished[idx] = True
+        if callback is not None and not callback(idx+1):
+          break
+      return self._collect(headers, finished)
+
+    pending = {self.threads.submit(read_header, fname): idx for idx, fname in enumerate(fnames)}
+    count = 0
+    while pending:
+      done, _ = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+      for fut in done:
+        idx = pending.pop(fut)
+        headers[idx] = fut.result()
+        finished[idx] = True
+        count += 1
+      if callback is not None and not callback(count):
+        for fut in pending:
+          fut.cancel()
+        break
+    return self._collect(headers, finished)
+
+  def stream(self, fnames):
+    # starts reading the headers of fnames in the background
+    return HeaderStream(self.threads, fnames)
+
+  def _collect(self, headers, finished):
+    datasets = []
+    discarded = 0
+    for header, done in zip(headers, finished):
+      if done and header is None:
+        discarded += 1
+      elif done:
+        datasets += header
+    datasets, duplicates = drop_duplicates(datasets)
+    return datasets, discarded, duplicates
+
+  def decode(self, fnames):
+    # yields HU images in the order of fnames, decoding a bounded number of
+    # files ahead in the process pool. archive members are decoded in threads
+    # since their archives are opened and cached per process.
+    if self.workers <= 1:
+      for fname in fnames:
+        yield decode_file(fname)
+      return
+    pool = self.threads if any(is_member(fname) for fname in fnames) else self.procs
+    ahead = 2*self.workers
+    futures = []
+    try:
+      for fname in fnames:
+        futures.append(pool.submit(decode_file, fname))
+        if len(futures) > ahead:
+          yield futures.pop(0).result()
+      while futures:
+        yield futures.pop(0).result()
+    finally:
+      for fut in futures:
+        fut.cancel()
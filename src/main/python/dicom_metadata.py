@@ -0,0 +1,81 @@
+from typing import NamedTuple, Optional, Tuple
+
+# tags needed to build the records below, so a header can be read with
+# specific_tags instead of parsing the whole file
+REFERENCE_TAGS = ['Rows', 'Columns', 'PixelSpacing', 'SliceThickness',
+                  'RescaleIntercept', 'RescaleSlope', 'ReconstructionDiameter',
+                  'SliceLocation', 'CTDIvol']
+PATIENT_TAGS = ['PatientID', 'PatientName', 'PatientSex', 'PatientAge',
+                'BodyPartExamined', 'AcquisitionDate', 'Manufacturer',
+                'ManufacturerModelName', 'InstitutionName']
+METADATA_TAGS = REFERENCE_TAGS + PATIENT_TAGS
+
+
+class ReferenceData(NamedTuple):
+  dimension: Tuple[int, int]
+  spacing: Optional[Tuple[float, float, float]]
+  intercept: float
+  slope: float
+  reconst_diameter: Optional[float]
+  slice_pos: Optional[float]
+  CTDI: float
+
+
+class PatientInfo(NamedTuple):
+  id: Optional[str]
+  name: Optional[str]
+  sex: Optional[str]
+  age: Optional[int]
+  protocol: Optional[str]
+  date: Optional[str]
+  brand: Optional[str]
+  model: Optional[str]
+  scanner: Optional[str]
+  instn: Optional[str]
+
+
+def get_value(ds, tag, cast=str):
+  # value of tag converted with cast, None when missing, empty or invalid
+  value = ds.get(tag)
+  if value is None or value == '':
+    return None
+  try:
+    return cast(value)
+  except (TypeError, ValueError):
+    return None
+
+def parse_age(value):
+  # DICOM AS (e.g. '045Y') to years
+  return int(str(value)[:3])
+
+def reference_data(ds):
+  try:
+    spacing = (float(ds.PixelSpacing[0]), float(ds.PixelSpacing[1]), float(ds.SliceThickness))
+  except:
+    spacing = None
+  return ReferenceData(
+    dimension=(int(ds.Rows), int(ds.Columns)),
+    spacing=spacing,
+    intercept=get_value(ds, 'RescaleIntercept', float) or 0.,
+    slope=get_value(ds, 'RescaleSlope', float) or 1.,
+    reconst_diameter=get_value(ds, 'ReconstructionDiameter', float),
+    slice_pos=get_value(ds, 'SliceLocation', float),
+    CTDI=get_value(ds, 'CTDIvol', float) or 0,
+  )
+
+def patient_info(ds):
+  brand = get_value(ds, 'Manufacturer') or ''
+  model = get_value(ds, 'ManufacturerModelName') or ''
+  scanner = brand + '-' + model
+  return PatientInfo(
+    id=get_value(ds, 'PatientID'),
+    name=get_value(ds, 'PatientName'),
+    sex=get_value(ds, 'PatientSex'),
+    age=get_value(ds, 'PatientAge', parse_age),
+    protocol=get_value(ds, 'BodyPartExamined'),
+    date=get_value(ds, 'AcquisitionDate'),
+    brand=brand or None,
+    model=model or None,
+    scanner=scanner if scanner != '-' else None,
+    instn=get_value(ds, 'InstitutionName'),
+  )
@@ -0,0 +1,123 @@
+import os
+
+from pydicom.dataset import Dataset
+
+from image_processing import get_dicom
+
+# values of the directory records copied into the series summary
+RECORD_TAGS = {
+  'PATIENT': ['PatientID', 'PatientName'],
+  'STUDY': ['StudyInstanceUID', 'StudyDate', 'StudyDescription'],
+  'SERIES': ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'Modality'],
+}
+
+
+class SeriesRecord:
+  # a series listed in a DICOMDIR: the patient, study and series record values
+  # in one dataset, and the paths of its files
+  def __init__(self, info, fnames):
+    self.info = info
+    self.fnames = fnames
+
+  def __len__(self):
+    return len(self.fnames)
+
+
+def find_dicomdir(root):
+  try:
+    names = os.listdir(root)
+  except OSError:
+    return None
+  for name in names:
+    if name.upper() == 'DICOMDIR' and os.path.isfile(os.path.join(root, name)):
+      return os.path.join(root, name)
+  return None
+
+def read_dicomdir(path):
+  # series listed in the DICOMDIR at path with their existing files, in
+  # directory order. only the DICOMDIR itself is read.
+  ds = get_dicom(path)
+  records = ds.get('DirectoryRecordSequence') or []
+  root = os.path.dirname(path)
+  series = []
+  for info, images in walk_records(ds, records):
+    fnames = []
+    for rec in images:
+      file_id = rec.get('ReferencedFileID')
+      if not file_id:
+        continue
+      parts = [file_id] if isinstance(file_id, str) else list(file_id)
+      fname = os.path.join(root, *parts)
+      if not os.path.isfile(fname):
+        fname = find_path(root, parts)
+      if fname is not None:
+        fnames.append(fname)
+    if fnames:
+      series.append(SeriesRecord(info, fnames))
+  return series
+
+def walk_records(ds, records):
+  # yields (series info, image records) following the offsets between the
+  # records, or the order of the records when offsets are not usable
+  by_offset = {getattr(rec, 'seq_item_tell', None): rec for rec in records}
+  first = ds.get('OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity')
+  if first in by_offset and None not in by_offset:
+    yield from _walk_offsets(by_offset, first, Dataset())
+    return
+  info = {}
+  images = None
+  for rec in records:
+    kind = str(rec.get('DirectoryRecordType', '')).upper()
+    if kind in RECORD_TAGS:
+      if images:
+        yield info['SERIES'], images
+      images = [] if kind == 'SERIES' else None
+      parent = info.get({'STUDY': 'PATIENT', 'SERIES': 'STUDY'}.get(kind), Dataset())
+      info[kind] = merge_record(parent, rec, kind)
+    elif images is not None:
+      images.append(rec)
+  if images:
+    yield info['SERIES'], images
+
+def _walk_offsets(by_offset, offset, parent):
+  for offset in _chain(by_offset, offset):
+    rec = by_offset[offset]
+    kind = str(rec.get('DirectoryRecordType', '')).upper()
+    if kind not in RECORD_TAGS:
+      continue
+    info = merge_record(parent, rec, kind)
+    lower = rec.get('OffsetOfReferencedLowerLevelDirectoryEntity')
+    if kind == 'SERIES':
+      yield info, [by_offset[o] for o in _chain(by_offset, lower)]
+    else:
+      yield from _walk_offsets(by_offset, lower, info)
+
+def _chain(by_offset, offset):
+  # offsets of a record and its siblings
+  seen = set()
+  while offset in by_offset and offset not in seen:
+    seen.add(offset)
+    yield offset
+    offset = by_offset[offset].get('OffsetOfTheNextDirectoryRecord')
+
+def merge_record(parent, rec, kind):
+  info = Dataset()
+  for elem in parent:
+    info.add(elem)
+  for tag in RECORD_TAGS[kind]:
+    if tag in rec:
+      info.add(rec[tag])
+  return info
+
+def find_path(root, parts):
+  # file IDs are upper case on media, the copied files may not be
+  path = root
+  for part in parts:
+    try:
+      names = {name.upper(): name for name in os.listdir(path)}
+    except OSError:
+      return None
+    if part.upper() not in names:
+      return None
+    path = os.path.join(path, names[part.upper()])
+  return path if os.path.isfile(path) else None
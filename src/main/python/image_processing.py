@@ -1,30 +1,300 @@
+import struct
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 
 import numpy as np
 import pydicom
 from pydicom.errors import InvalidDicomError
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
 from scipy import ndimage as ndi
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.morphology import dilation, disk, erosion
 
+from archive import is_member, open_source
+from dicom_metadata import METADATA_TAGS, patient_info, reference_data
+from multiframe import frame_rescale
+from series import HeaderTable
+
+try:
+  from pydicom.pixels import pixel_array as read_pixels
+except ImportError: # pydicom < 3 can only decode every frame at once
+  read_pixels = None
+
+NATIVE_SYNTAXES = [ImplicitVRLittleEndian, ExplicitVRLittleEndian]
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+# one record per labelled region, bbox is (min_row, min_col, max_row, max_col)
+# with the max values exclusive
+REGION_DTYPE = np.dtype([
+  ('label', np.intp), ('area', np.intp), ('centroid', np.float64, 2),
+  ('bbox', np.intp, 4), ('mean_intensity', np.float64),
+])
+# morphology and labelling run on the bounding box of the body grown by this
+# many pixels, 1 keeps the hole filling exact and the table removal needs
+# the radius of its dilation
+CROP_MARGIN = 1
+TABLE_DILATION = 10
+# downsampling factors of the segmentation preview pyramid, and the number of
+# rows the preview level should not exceed
+PYRAMID_FACTORS = (2, 4)
+PREVIEW_SIZE = 256
+
+
+class Segmentation:
+  # a segmented image: the mask, the label image of its objects (numbered
+  # 1..n), their region statistics (largest first, see get_regprops) and the
+  # bounding box of all objects. the diameter, centre, truncation and
+  # correction functions take it, so the mask is labelled only once.
+  def __init__(self, mask, labels, regions):
+    self.mask = mask
+    self.labels = labels
+    self.regions = regions
+
+  @property
+  def bbox(self):
+    boxes = self.regions['bbox']
+    return (int(boxes[:, 0].min()), int(boxes[:, 1].min()),
+            int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+
+  def region_image(self, idx=0):
+    return get_region_image(self.labels, self.regions[idx])
+
+  def mean_intensity(self, img):
+    # mean of img over every object, in the order of the regions
+    crop = bbox_slices(self.bbox)
+    total = np.bincount(self.labels[crop].ravel(), weights=np.asarray(img, dtype=np.float64)[crop].ravel())
+    return total[self.regions['label']] / self.regions['area']
+
+
+def as_segmentation(mask):
+  # masks that do not come from get_mask (e.g. drawn ROIs) are labelled here
+  if isinstance(mask, Segmentation):
+    return mask
+  mask = np.asarray(mask).astype(bool)
+  found = label_objects(mask, fill_holes=False)
+  if found is None:
+    return Segmentation(mask, np.zeros(mask.shape, dtype=np.int32), np.zeros(0, dtype=REGION_DTYPE))
+  box, labels, regions = found
+  return Segmentation(mask, uncrop(labels, box, mask.shape), regions)
+
+def mask_array(mask):
+  return mask.mask if isinstance(mask, Segmentation) else mask
+
+def get_hu_imgs(scans, idxs=None, out=None, workers=1, callback=None, frames=None, hist=None):
+  # converts the scans (datasets or file names) at idxs into one preallocated
+  # (n, rows, cols) int16 volume, filled in place. frames holds the frame
+  # number of each scan in a multi-frame file (None for single frame files),
+  # such files are decoded once for all of their frames. callback(count)
+  # returns False to cancel, in which case None is returned. hist (an
+  # HUHistogram) gets the HU values of every file as it is converted.
+  idxs = range(len(scans)) if idxs is None else idxs
+  if not len(idxs):
+    return np.empty((0, 0, 0), dtype=np.int16) if out is None else out
+  if out is None:
+    ref = scans[idxs[0]]
+    if isinstance(ref, str):
+      ref = get_dicom(ref, stop_before_pixels=True)
+    out = np.empty((len(idxs), int(ref.Rows), int(ref.Columns)), dtype=np.int16)
+
+  units = []
+  multi = {}
+  for pos, idx in enumerate(idxs):
+    if frames is None or frames[idx] is None:
+      units.append([pos])
+    elif scans[idx] in multi:
+      multi[scans[idx]].append(pos)
+    else:
+      multi[scans[idx]] = [pos]
+      units.append(multi[scans[idx]])
+
+  def fill(unit):
+    scan = scans[idxs[unit[0]]]
+    ds = get_dicom(scan) if isinstance(scan, str) else scan
+    if (int(ds.Rows), int(ds.Columns)) != out.shape[1:]:
+      raise ValueError(f'Cannot convert slice {idxs[unit[0]]+1} to the volume.')
+    if frames is None or frames[idxs[unit[0]]] is None:
+      if get_hu_img(ds, out=out[unit[0]]) is None:
+        raise ValueError(f'Cannot convert slice {idxs[unit[0]]+1} to the volume.')
+      if hist is not None:
+        hist.add(idxs[unit[0]], out[unit[0]])
+      return 1
+    hu = get_hu_frames(ds)
+    if hu is None:
+      raise ValueError(f'Cannot convert slice {idxs[unit[0]]+1} to the volume.')
+    for pos in unit:
+      out[pos] = hu[frames[idxs[pos]]]
+    if hist is not None:
+      hist.add(idxs[unit[0]], hu)
+    return len(unit)
+
+  if workers <= 1:
+    count = 0
+    for unit in units:
+      count += fill(unit)
+      if callback is not None and not callback(count):
+        return
+    return out
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    pending = {executor.submit(fill, unit) for unit in units}
+    count = 0
+    try:
+      while pending:
+        done, pending = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+        for fut in done:
+          count += fut.result()
+        if callback is not None and not callback(count):
+          return
+    finally:
+      # on cancel or on the first error, the slices not started are dropped
+      for fut in pending:
+        fut.cancel()
+  return out
+
+def get_hu_img(ds, out=None):
+  try:
+    raw = get_native_pixels(ds)
+    if raw is None:
+      raw = ds.pixel_array
+      release_pixel_cache(ds)
+    slope = float(ds.RescaleSlope)
+    intercept = float(ds.RescaleIntercept)
+  except:
+    return
+  return to_hu(raw, slope, intercept, out)
+
+def to_hu(raw, slope, intercept, out=None):
+  if out is None:
+    if raw.dtype == np.int16 and slope == 1 and intercept == 0:
+      return raw
+    out = np.empty(raw.shape, dtype=np.int16)
+  if slope == 1 and intercept == int(intercept):
+    np.copyto(out, raw, casting='unsafe')
+    out += np.int16(intercept)
+  else:
+    np.copyto(out, raw*np.float32(slope) + np.float32(intercept), casting='unsafe')
+  return out
 
-def get_hu_imgs(scans):
-  imgs = np.stack([get_hu_img(ds) for ds in scans])
-  return imgs
-
-def get_hu_img(ds):
+def get_hu_frames(ds):
+  # (frames, rows, cols) HU array of a multi-frame image with the rescale of
+  # each frame, the frames are views into it
   try:
-    img = ds.pixel_array*ds.RescaleSlope + ds.RescaleIntercept
+    raw = get_native_pixels(ds)
+    if raw is None:
+      raw = ds.pixel_array
+      release_pixel_cache(ds)
+    slopes, intercepts = frame_rescale(ds)
+  except:
+    return
+  if raw.ndim == 2:
+    raw = raw[np.newaxis]
+  if raw.dtype == np.int16 and (slopes == 1).all() and (intercepts == 0).all():
+    return raw
+  out = np.empty(raw.shape, dtype=np.int16)
+  if (slopes == 1).all() and (intercepts == np.round(intercepts)).all():
+    np.copyto(out, raw, casting='unsafe')
+    out += intercepts.astype(np.int16)[:, np.newaxis, np.newaxis]
+  else:
+    hu = raw*slopes.astype(np.float32)[:, np.newaxis, np.newaxis] + intercepts.astype(np.float32)[:, np.newaxis, np.newaxis]
+    np.copyto(out, hu, casting='unsafe')
+  return out
+
+def get_hu_frame(fname, frame, slope=1, intercept=0):
+  # HU image of one frame of a multi-frame file, slope and intercept are the
+  # rescale of that frame (from its slice record). uncompressed frames are
+  # read from their place in the file, compressed ones are decoded alone by
+  # pydicom 3 and with the whole file by older versions.
+  try:
+    layout = frame_layout(fname)
+    if layout is not None:
+      raw = read_native_frame(fname, frame, layout)
+    elif read_pixels is not None:
+      raw = read_pixels(open_source(fname), index=frame)
+    else:
+      raw = get_dicom(fname).pixel_array
+      raw = np.array(raw[frame] if raw.ndim == 3 else raw)
+    return to_hu(raw, float(slope), float(intercept))
   except:
     return
-  return np.array(img, dtype=np.int16)
 
-def get_dicom(*args, **kwargs):
+@lru_cache(maxsize=64)
+def frame_layout(fname):
+  # (offset of the first frame, dtype, rows, cols, bits stored) of an
+  # uncompressed little endian 16 bit image, None when its frames cannot be
+  # read straight from the file. the header is parsed once per file.
+  src = open_source(fname)
+  with (open(src, 'rb') if isinstance(src, str) else src) as f:
+    ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+    tsyntax = getattr(ds, 'file_meta', {}).get('TransferSyntaxUID')
+    if tsyntax not in NATIVE_SYNTAXES:
+      return
+    if int(ds.get('SamplesPerPixel', 1)) != 1 or int(ds.BitsAllocated) != 16:
+      return
+    # dcmread leaves the file at the start of the PixelData element
+    pos = f.tell()
+    head = f.read(12)
+  if len(head) < 12 or struct.unpack('<HH', head[:4]) != PIXEL_DATA_TAG:
+    return
+  if tsyntax == ImplicitVRLittleEndian or head[4:6] not in (b'OB', b'OW', b'UN'):
+    length, offset = struct.unpack('<I', head[4:8])[0], pos + 8
+  else:
+    length, offset = struct.unpack('<I', head[8:12])[0], pos + 12
+  rows, cols = int(ds.Rows), int(ds.Columns)
+  if length < int(ds.get('NumberOfFrames') or 1) * rows * cols * 2: # also undefined length
+    return
+  dtype = '<i2' if int(ds.PixelRepresentation) == 1 else '<u2'
+  return offset, dtype, rows, cols, int(ds.get('BitsStored', 16))
+
+def read_native_frame(fname, frame, layout):
+  offset, dtype, rows, cols, bits = layout
+  size = rows * cols * 2
+  src = open_source(fname)
+  with (open(src, 'rb') if isinstance(src, str) else src) as f:
+    f.seek(offset + frame * size)
+    buf = f.read(size)
+  if len(buf) < size:
+    raise ValueError(f'{fname} is truncated.')
+  raw = np.frombuffer(buf, dtype=dtype).reshape(rows, cols)
+  return stored_bits(raw, bits, dtype == '<i2')
+
+def get_native_pixels(ds):
+  # view of the PixelData bytes for uncompressed little endian 16 bit
+  # images, (frames, rows, cols) for multi-frame images. None when
+  # pixel_array has to be used instead
+  file_meta = getattr(ds, 'file_meta', None)
+  if file_meta is None or file_meta.get('TransferSyntaxUID') not in NATIVE_SYNTAXES or 'PixelData' not in ds:
+    return
+  if int(ds.get('SamplesPerPixel', 1)) != 1:
+    return
+  if int(ds.BitsAllocated) != 16:
+    return
+  nframes = int(ds.get('NumberOfFrames') or 1)
+  shape = (int(ds.Rows), int(ds.Columns))
+  if nframes > 1:
+    shape = (nframes,) + shape
+  signed = int(ds.PixelRepresentation) == 1
+  raw = np.frombuffer(ds.PixelData, dtype='<i2' if signed else '<u2', count=int(np.prod(shape)))
+  return stored_bits(raw.reshape(shape), int(ds.get('BitsStored', 16)), signed)
+
+def stored_bits(raw, bits, signed):
+  # keeps the low bits of each pixel, sign extended for signed data
+  if bits < 16:
+    shift = 16 - bits
+    raw = (raw << shift) >> shift if signed else raw & ((1 << bits) - 1)
+  return raw
+
+def release_pixel_cache(ds):
+  ds._pixel_array = None
+  ds._pixel_id = {}
+
+def get_dicom(fname, **kwargs):
   try:
-    dcm = pydicom.dcmread(*args, **kwargs)
+    dcm = pydicom.dcmread(open_source(fname), **kwargs)
   except InvalidDicomError as e:
     kwargs['force'] = True
-    dcm = pydicom.dcmread(*args, **kwargs)
+    dcm = pydicom.dcmread(open_source(fname), **kwargs)
+  if is_member(fname):
+    dcm.filename = fname
   if not hasattr(dcm.file_meta, 'TransferSyntaxUID'): # Assume transder syntax
     dcm.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2' # Implicit VR Endian
     # dcm.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1' # Explicit VR Little Endian
@@ -33,129 +303,222 @@ def get_dicom(*args, **kwargs):
   return dcm
 
 def reslice(dcms, reverse=False):
-  slices = []
-  skipcount = 0
-  for dcm in dcms:
-    if hasattr(dcm, 'SliceLocation'):
-      slices.append(dcm)
-    else:
-      skipcount += 1
-
-  slices = sorted(slices, key=lambda s: s.SliceLocation, reverse=reverse)
-  return slices, skipcount
+  order, skipcount = get_slice_order(HeaderTable(dcms), reverse)
+  return [dcms[idx] for idx in order], skipcount
+
+def get_slice_order(table, reverse=False):
+  # sort by position along the slice normal, then acquisition time and
+  # instance number. slices without a position are skipped.
+  pos = table.slice_positions()
+  valid = np.flatnonzero(~np.isnan(pos))
+  pos = pos[valid]
+  keys = (table.instance_number[valid], table.acquisition_time[valid], -pos if reverse else pos)
+  order = valid[np.lexsort(keys)]
+  return order, len(table) - len(valid)
+
+def get_repeated_slices(table, order, decimals=2):
+  # groups the sorted slices acquired at the same position. returns the group
+  # id of each slice and the number of acquisitions in each group.
+  pos = np.round(table.slice_positions()[order], decimals)
+  start = np.ones(len(pos), dtype=bool)
+  start[1:] = pos[1:] != pos[:-1]
+  groups = np.cumsum(start) - 1
+  counts = np.bincount(groups) if len(groups) else np.zeros(0, dtype=int)
+  return groups, counts
 
 def get_reference(file):
-  ref = pydicom.dcmread(file)
-  ref_data = {
-    'dimension': (int(ref.Rows), int(ref.Columns)),
-    'spacing': (float(ref.PixelSpacing[0]), float(ref.PixelSpacing[1]), float(ref.SliceThickness)),
-    'intercept': float(ref.RescaleIntercept),
-    'slope': float(ref.RescaleSlope),
-    'reconst_diameter': float(ref.ReconstructionDiameter),
-    'slice_pos': float(ref.SliceLocation),
-    'CTDI': float(ref.CTDIvol) if 'CTDIvol' in ref else 0
-  }
-  patient_info = {
-    'name': str(ref.PatientName) if 'PatientName' in ref else None,
-    'sex': str(ref.PatientSex) if 'PatientSex' in ref else None,
-    'age': str(ref.PatientAge) if 'PatientAge' in ref else None,
-    'protocol': str(ref.BodyPartExamined) if 'BodyPartExamined' in ref else None,
-    'date': str(ref.AcquisitionDate) if 'AcquisitionDate' in ref else None
-  }
-  return ref_data, patient_info
+  # reads only the header tags of the records, never the pixel data
+  ref = get_dicom(file, stop_before_pixels=True, specific_tags=METADATA_TAGS)
+  return reference_data(ref), patient_info(ref)
 
 def get_img_no_table(img, threshold=-200):
   thres = img>threshold
-  fill = ndi.binary_fill_holes(thres)
-  labels = label(fill)
+  no_table = img.copy()
+  found = label_objects(thres, margin=TABLE_DILATION)
+  if found is None:
+    return no_table
+  box, labels, regprops = found
 
-  regprops = get_regprops(labels)
-  tables = np.zeros_like(labels, dtype=bool)
-  for region in regprops:
-    if region.centroid[0] > labels.shape[0]*7.5//10:
-      tables = tables | (labels==region.label)
+  # lookup table over the label ids, the table mask is gathered in one pass
+  is_table = np.zeros(labels.max()+1, dtype=bool)
+  is_table[regprops['label'][regprops['centroid'][:, 0] > img.shape[0]*7.5//10]] = True
 
-  tables = dilation(tables, disk(10))
-  no_table = img.copy()
-  no_table[tables] = -1000
+  tables = dilation(is_table[labels], disk(TABLE_DILATION))
+  no_table[bbox_slices(box)][tables] = -1000
   return no_table
 
-def get_mask(img, threshold=-300, minimum_area=500, num_of_objects=5, largest_only=False, return_label=False):
+def get_mask(img, threshold=-300, minimum_area=500, num_of_objects=5, largest_only=False):
+  # segments the objects of img, returns a Segmentation or None when no
+  # object is found
   if largest_only:
     num_of_objects = 1
   thres = img>threshold
-  fill = ndi.binary_fill_holes(thres)
-  labels = label(fill)
-  if labels.max() == 0:
-    return (None, None) if return_label else None
-
-  regprops = get_regprops(labels)
-  obj_count = 0
-  segments = np.zeros_like(labels, dtype=bool)
-  for region in regprops:
-    if region.centroid[0] < labels.shape[0]*7//10 and region.area >= minimum_area:
-      segments = segments | (labels==region.label)
-      obj_count += 1
-    if obj_count == num_of_objects:
-      break
+  found = label_objects(thres)
+  if found is None:
+    return None
+  box, labels, regprops = found
+
+  # lookup table of the kept label ids, the mask is gathered in one pass
+  objects = regprops[(regprops['centroid'][:, 0] < img.shape[0]*7//10) & (regprops['area'] >= minimum_area)]
+  objects = objects[:num_of_objects]
+  obj_count = len(objects)
+  keep = np.zeros(labels.max()+1, dtype=bool)
+  keep[objects['label']] = True
   if obj_count == 0:
-    return (None, None) if return_label else None
-
-  labels = label(segments)
-  return (segments, labels) if return_label else segments
+    return None
+
+  segments = uncrop(keep[labels], box, img.shape)
+  # kept objects are numbered in the order of their labels, which is what
+  # labelling segments again would give. their statistics stay valid.
+  relabel = np.zeros(len(keep), dtype=labels.dtype)
+  relabel[keep] = np.arange(1, obj_count+1)
+  objects['label'] = relabel[objects['label']]
+  return Segmentation(segments, uncrop(relabel[labels], box, img.shape), objects)
+
+def downsample(img, factor):
+  # block mean of img over factor x factor pixels, the rows and columns that
+  # do not fill a block are dropped
+  rows, cols = img.shape[0]//factor, img.shape[1]//factor
+  blocks = img[:rows*factor, :cols*factor].reshape(rows, factor, cols, factor)
+  return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def get_pyramid(img, factors=PYRAMID_FACTORS):
+  # downsampled copies of img keyed by factor, each level is made from the
+  # one before it
+  levels = {}
+  level, prev = img, 1
+  for factor in sorted(factors):
+    level = downsample(level, factor//prev)
+    levels[factor] = level
+    prev = factor
+  return levels
+
+def preview_factor(shape, size=PREVIEW_SIZE):
+  # the smallest pyramid factor that brings shape down to size rows
+  for factor in sorted(PYRAMID_FACTORS):
+    if max(shape)//factor <= size:
+      return factor
+  return max(PYRAMID_FACTORS)
+
+def get_mask_preview(level, factor, threshold=-300, minimum_area=500, **kwargs):
+  # get_mask on a pyramid level, minimum_area is given in full resolution
+  # pixels. only meant for display, diameters always come from get_mask.
+  return get_mask(level, threshold=threshold, minimum_area=minimum_area/factor**2, **kwargs)
+
+def get_bbox(mask, margin=0):
+  # (min_row, min_col, max_row, max_col) of the nonzero pixels of mask, from
+  # its row and column projections, grown by margin and clipped to the
+  # image. None when mask is empty.
+  rows = np.flatnonzero(mask.any(axis=1))
+  if not rows.size:
+    return None
+  cols = np.flatnonzero(mask.any(axis=0))
+  return (max(int(rows[0])-margin, 0), max(int(cols[0])-margin, 0),
+          min(int(rows[-1])+1+margin, mask.shape[0]), min(int(cols[-1])+1+margin, mask.shape[1]))
+
+def bbox_slices(bbox):
+  return slice(bbox[0], bbox[2]), slice(bbox[1], bbox[3])
+
+def uncrop(cropped, bbox, shape):
+  # cropped placed at bbox in a zero image of the given shape
+  full = np.zeros(shape, dtype=cropped.dtype)
+  full[bbox_slices(bbox)] = cropped
+  return full
+
+def label_objects(mask, margin=CROP_MARGIN, fill_holes=True):
+  # labels the objects of mask (holes filled first) within their bounding
+  # box grown by margin. returns (box, label image of the box, region
+  # statistics in image coordinates), None when mask is empty.
+  box = get_bbox(mask, margin)
+  if box is None:
+    return None
+  objects = mask[bbox_slices(box)]
+  if fill_holes:
+    objects = ndi.binary_fill_holes(objects)
+  labels = label(objects)
+  return box, labels, get_regprops(labels, offset=box[:2])
 
 def get_coord(grid, x):
   where = np.where(grid==x)
   list_of_coordinates = tuple(zip(where[0], where[1]))
   return list_of_coordinates
 
-def get_regprops(mask, img=None):
-  r_props = regionprops(mask.astype(int), intensity_image=img)
-  r_props.sort(key=lambda reg: reg.area, reverse=True)
-  return r_props
+def get_regprops(mask, img=None, offset=(0, 0)):
+  # area, centroid, bounding box and mean intensity (when img is given) of
+  # every label in mask, computed for all labels at once. offset is the
+  # position of mask in the image, added to the centroids and boxes. returns
+  # a REGION_DTYPE array sorted by area, largest first.
+  labels = np.asarray(mask).astype(np.int32, copy=False)
+  n = int(labels.max()) if labels.size else 0
+  flat = labels.ravel()
+  area = np.bincount(flat, minlength=n+1)
+  ids = np.flatnonzero(area[1:]) + 1
+  regions = np.zeros(len(ids), dtype=REGION_DTYPE)
+  regions['label'] = ids
+  regions['area'] = area[ids]
+  if len(ids):
+    rows, cols = labels.shape
+    for axis, index in enumerate([np.arange(rows).repeat(cols), np.tile(np.arange(cols), rows)]):
+      regions['centroid'][:, axis] = np.bincount(flat, weights=index, minlength=n+1)[ids] / area[ids]
+    boxes = ndi.find_objects(labels, max_label=n)
+    regions['bbox'] = [(r.start, c.start, r.stop, c.stop) for r, c in (boxes[i-1] for i in ids)]
+  if img is not None:
+    total = np.bincount(flat, weights=np.asarray(img, dtype=np.float64).ravel(), minlength=n+1)
+    regions['mean_intensity'] = total[ids] / area[ids]
+  regions['centroid'] += offset
+  regions['bbox'] += tuple(offset) * 2
+  return regions[np.argsort(-regions['area'], kind='stable')]
+
+def get_region_image(labels, region):
+  # mask of region within its bounding box
+  min_row, min_col, max_row, max_col = region['bbox']
+  return labels[min_row:max_row, min_col:max_col] == region['label']
 
 def get_dw_value(img, mask, dims, rd, is_truncated=False, largest_only=False):
   r,c = dims
-  lbl = label(mask)
-  roi = get_regprops(lbl, img)
+  seg = as_segmentation(mask)
+  roi = seg.regions
+  means = seg.mean_intensity(img)
   if largest_only:
-    px_area = roi[0].area
-    avg = roi[0].mean_intensity
+    px_area = roi[0]['area']
+    avg = means[0]
   else:
-    objs_area = [reg.area for reg in roi]
-    objs_avg = [reg.mean_intensity for reg in roi]
-    px_area = sum(objs_area)
-    avg = sum(objs_avg)/len(objs_avg)
+    px_area = roi['area'].sum()
+    avg = means.mean()
   area = px_area*(rd**2)/(r*c)
   dw = 0.1*2*np.sqrt(((avg/1000)+1)*(area/np.pi))
   if is_truncated:
-    percent = truncation(mask)
+    percent = truncation(seg)
     dw *= np.exp(1.14e-6 * percent**3)
   return dw
 
 def get_center(mask):
-  lbl = label(mask)
-  roi = get_regprops(lbl)
-  centroid = roi[0].centroid
+  centroid = as_segmentation(mask).regions[0]['centroid']
   return tuple([int(x) for x in centroid])
 
 def get_center_max(mask):
-  lbl = label(mask)
-  roi = get_regprops(lbl)
-  bb = roi[0].image
-  min_row, min_col, _, _ = roi[0].bbox
-  bbrow, bbcol = bb.shape
-  len_rows = np.array([bb[:, c].sum() for c in range(bbcol)])
-  len_cols = np.array([bb[r, :].sum() for r in range(bbrow)])
+  seg = as_segmentation(mask)
+  bb = seg.region_image()
+  min_row, min_col, _, _ = seg.regions[0]['bbox']
+  len_rows = bb.sum(axis=0)
+  len_cols = bb.sum(axis=1)
   return (int(np.argmax(len_cols) + min_row), int(np.argmax(len_rows) + min_col))
 
 def get_correction_mask(img, mask=None, lb_bone=250, lb_stissue=-250):
   if mask is None:
     mask = get_mask(img)
-  corr_mask = mask.astype(int)
-  corr_mask[(corr_mask==1) & (img<lb_stissue)] = 20
-  corr_mask[(corr_mask==1) & (img<lb_bone)] = 40
-  corr_mask[(corr_mask==1)] = 60
+  mask = mask_array(mask)
+  corr_mask = np.zeros(mask.shape, dtype=int)
+  box = get_bbox(mask)
+  if box is None:
+    return corr_mask
+  crop = bbox_slices(box)
+  body = mask[crop].astype(int)
+  img = img[crop]
+  body[(body==1) & (img<lb_stissue)] = 20
+  body[(body==1) & (img<lb_bone)] = 40
+  body[(body==1)] = 60
+  corr_mask[crop] = body
   return corr_mask
 
 def get_deff_correction(correction, corr_mask, center, rd):
@@ -178,24 +541,24 @@ def get_deff_correction(correction, corr_mask, center, rd):
   return deff, corr_len_r, corr_len_c
 
 def get_deff_value(mask, dims, rd, method):
-  lbl = label(mask)
+  seg = as_segmentation(mask)
   r,c = dims
-  roi = get_regprops(lbl)
-  px_area = roi[0].area
-  bb = roi[0].image
+  roi = seg.regions
+  px_area = roi[0]['area']
+  bb = seg.region_image()
   cen_row = cen_col = len_row = len_col = None
-  row, col = lbl.shape
+  row, col = seg.labels.shape
   if method == 'area':
     area = px_area*(rd**2)/(r*c)
     deff = 2*0.1*np.sqrt(area/np.pi)
   elif method == 'center':
-    bb_cen_row, bb_cen_col = roi[0].local_centroid
+    bb_cen_row, bb_cen_col = roi[0]['centroid'] - roi[0]['bbox'][:2]
     bb_cen_row, bb_cen_col = int(bb_cen_row), int(bb_cen_col)
 
     nrow1 = sum(bb[:, bb_cen_col])
     ncol1 = sum(bb[bb_cen_row, :])
 
-    cen_row, cen_col = roi[0].centroid
+    cen_row, cen_col = roi[0]['centroid']
     cen_row, cen_col = int(cen_row), int(cen_col)
 
     len_row = nrow1 * (0.1*rd/row)
@@ -203,11 +566,10 @@ def get_deff_value(mask, dims, rd, method):
 
     deff = np.sqrt(len_row*len_col)
   elif method == 'max':
-    min_row, min_col, max_row, max_col = roi[0].bbox
+    min_row, min_col, max_row, max_col = roi[0]['bbox']
 
-    bbrow, bbcol = bb.shape
-    len_rows = np.array([bb[:, c].sum() for c in range(bbcol)])
-    len_cols = np.array([bb[r, :].sum() for r in range(bbrow)])
+    len_rows = bb.sum(axis=0)
+    len_cols = bb.sum(axis=1)
 
     len_row = np.max(len_rows) * (0.1*rd/row)
     len_col = np.max(len_cols) * (0.1*rd/col)
@@ -221,7 +583,7 @@ def get_deff_value(mask, dims, rd, method):
   return deff, cen_row, cen_col, len_row, len_col
 
 def truncation(mask):
-  row, col = mask.shape
+  row, col = mask_array(mask).shape
   pos = get_mask_pos(mask)
   edge_row = (pos[:,0]==0) | (pos[:,0]==row-1)
   edge_col = (pos[:,1]==0) | (pos[:,1]==col-1)
@@ -230,10 +592,13 @@ def truncation(mask):
   return (edge_area/area) * 100
 
 def get_mask_pos(mask):
+  mask = mask_array(mask)
+  box = get_bbox(mask) or (0, 0) + mask.shape
+  mask = mask[bbox_slices(box)]
   pad = np.zeros((mask.shape[0]+2, mask.shape[1]+2))
   pad[1:mask.shape[0]+1, 1:mask.shape[1]+1] = mask
   edges = pad - erosion(pad, disk(1))
-  pos = np.array(get_coord(edges, True))-1
+  pos = np.array(get_coord(edges, True)).reshape(-1, 2) - 1 + box[:2]
   return pos
 
 def windowing(img, window_width, window_level):
@@ -251,10 +616,11 @@ if __name__ == "__main__":
   ds = get_dicom(sys.argv[1])
   ref, _ = get_reference(sys.argv[1])
   img = get_hu_img(ds)
-  area, _, _, _, _ = get_deff_value(get_mask(img), ref['dimension'], ref['reconst_diameter'], 'area')
-  center, _, _, _, _ = get_deff_value(get_mask(img), ref['dimension'], ref['reconst_diameter'], 'center')
-  _max, _, _, _, _ = get_deff_value(get_mask(img), ref['dimension'], ref['reconst_diameter'], 'max')
-  dw = get_dw_value(img, get_mask(img), ref['dimension'], ref['reconst_diameter'])
+  seg = get_mask(img)
+  area, _, _, _, _ = get_deff_value(seg, ref.dimension, ref.reconst_diameter, 'area')
+  center, _, _, _, _ = get_deff_value(seg, ref.dimension, ref.reconst_diameter, 'center')
+  _max, _, _, _, _ = get_deff_value(seg, ref.dimension, ref.reconst_diameter, 'max')
+  dw = get_dw_value(img, seg, ref.dimension, ref.reconst_diameter)
   print(f'deff area = {area: #.2f} cm')
   print(f'deff center = {center: #.2f} cm')
   print(f'deff max = {_max: #.2f} cm')
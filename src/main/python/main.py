@@ -1,12 +1,15 @@
 import json
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
 
 import numpy as np
 import qimage2ndarray
 from fbs_runtime.application_context.PyQt5 import (ApplicationContext,
                                                    cached_property)
-from PyQt5.QtCore import QObject, Qt, pyqtSignal
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon, QIntValidator
 from PyQt5.QtSql import QSqlTableModel
 from PyQt5.QtWidgets import (QAbstractSpinBox, QAction,
@@ -18,13 +21,23 @@ from PyQt5.QtWidgets import (QAbstractSpinBox, QAction,
 
 import Plot as plt
 from AppConfig import AppConfig
+from archive import close_all as close_archives
 from constants import *
 from db import Database, create_patients_table, get_records_num, insert_patient
 from DBViewer import DBViewer
+from deidentify import export_series, get_profile
+from dicom_loader import (DicomLoader, decode_frames, default_workers,
+                          group_series, series_uid)
+from dicom_metadata import PatientInfo, patient_info
+from dicomdir import find_dicomdir, read_dicomdir
 from dicomtree import DicomTree
-from image_processing import (get_dicom, get_hu_img, get_hu_imgs, reslice,
-                              windowing)
+from image_processing import (get_hu_imgs, get_repeated_slices,
+                              get_slice_order, windowing)
 from patient_info import InfoPanel
+from series import (DEFAULT_CACHE_MB, DEFAULT_PREFETCH, HeaderTable, HUCache,
+                    HUHistogram, HUVolume, Prefetcher)
+from series_cache import DEFAULT_DISK_CACHE_MB, SeriesCache
+from series_selector import SeriesSelector
 from tab_Analyze import AnalyzeTab
 from tab_CTDIvol import CTDIVolTab
 from tab_Diameter import DiameterTab
@@ -38,6 +51,9 @@ class MainWindow(QMainWindow):
     self.ctx = ctx
     self.configs = AppConfig(self.ctx)
     self.rec_viewer = None
+    self.stream = None
+    self.stream_timer = QTimer(self)
+    self.stream_timer.setInterval(50)
     self.dt = DicomTree(parent=self)
     self.initVar()
     self.initModel()
@@ -47,8 +63,8 @@ class MainWindow(QMainWindow):
 
   def initVar(self):
     self.ctx.initVar()
-    pat_field = ['id', 'name', 'sex', 'age', 'protocol', 'date', 'brand', 'model', 'scanner', 'instn']
-    self.patient_info = dict(zip(pat_field, [None]*len(pat_field)))
+    self.dropped = 0 # slices taken out of the series, not reported yet
+    self.patient_info = dict.fromkeys(PatientInfo._fields)
     self.window_width = self.ctx.windowing_model.record(0).value("windowwidth")
     self.window_level = self.ctx.windowing_model.record(0).value("windowlevel")
 
@@ -98,8 +114,10 @@ class MainWindow(QMainWindow):
     self.on_phantom_update(0)
     self.open_btn.triggered.connect(self.on_open_files)
     self.open_folder_btn.triggered.connect(self.on_open_folder)
+    self.open_archive_btn.triggered.connect(self.on_open_archive)
     self.open_sample_btn.triggered.connect(self.on_open_sample)
     self.dcmtree_btn.triggered.connect(self.on_dcmtree)
+    self.export_btn.triggered.connect(self.on_export_anonymized)
     self.settings_btn.triggered.connect(self.on_open_config)
     self.help_btn_en.triggered.connect(lambda a: self.on_help('en'))
     self.help_btn_id.triggered.connect(lambda a: self.on_help('id'))
@@ -107,10 +125,11 @@ class MainWindow(QMainWindow):
     self.openrec_btn.triggered.connect(self.on_open_viewer)
     self.next_btn.triggered.connect(self.on_next_img)
     self.prev_btn.triggered.connect(self.on_prev_img)
-    self.close_img_btn.triggered.connect(self.on_close_image)
+    self.close_img_btn.triggered.connect(self.on_close_source)
     self.go_to_slice_btn.clicked.connect(self.on_go_to_slice)
     self.go_to_slice_sb.editingFinished.connect(self.on_go_to_slice_edit_finish)
     self.sort_btn.clicked.connect(self.on_sort)
+    self.stream_timer.timeout.connect(self.on_stream_tick)
     self.ssde_tab.save_btn.clicked.connect(self.on_save_db)
     self.ctdiv_tab.next_tab_btn.clicked.connect(self.on_next_tab)
     self.ctdiv_tab.prev_tab_btn.clicked.connect(self.on_prev_tab)
@@ -132,6 +151,9 @@ class MainWindow(QMainWindow):
     self.open_folder_btn = QAction(self.ctx.folder_icon, 'Open Folder', self)
     self.open_folder_btn.setStatusTip('Open Folder')
 
+    self.open_archive_btn = QAction(self.ctx.open_icon, 'Open Archive', self)
+    self.open_archive_btn.setStatusTip('Open DICOM Files in a Zip/Tar Archive')
+
     self.open_sample_btn = QAction(self.ctx.sample_icon, 'Open Sample', self)
     self.open_sample_btn.setStatusTip('Load Sample DICOM Files')
 
@@ -139,6 +161,10 @@ class MainWindow(QMainWindow):
     self.dcmtree_btn.setStatusTip('DICOM Info')
     self.dcmtree_btn.setEnabled(False)
 
+    self.export_btn = QAction(self.ctx.save_icon, 'Export Anonymized', self)
+    self.export_btn.setStatusTip('Export De-identified Copies of the Images')
+    self.export_btn.setEnabled(False)
+
     self.settings_btn = QAction(self.ctx.setting_icon, 'Settings', self)
     self.settings_btn.setStatusTip('Application Settings')
 
@@ -156,8 +182,10 @@ class MainWindow(QMainWindow):
 
     toolbar.addAction(self.open_btn)
     toolbar.addAction(self.open_folder_btn)
+    toolbar.addAction(self.open_archive_btn)
     toolbar.addAction(self.open_sample_btn)
     toolbar.addAction(self.dcmtree_btn)
+    toolbar.addAction(self.export_btn)
     toolbar.addAction(self.settings_btn)
     toolbar.addWidget(self.help_act)
 
@@ -292,22 +320,63 @@ class MainWindow(QMainWindow):
   def on_open_folder(self):
     dir = QFileDialog.getExistingDirectory(self,"Open Folder", "")
     if dir:
-      filenames = []
-      for f in os.listdir(dir):
-        fullfile = os.path.join(dir, f)
-        _, ext = os.path.splitext(f)
-        if os.path.isfile(fullfile) and (ext == '.dcm' or ext == ''):
-          filenames.append(fullfile)
+      filenames = self.read_dicomdir(dir)
+      if filenames is False: # series choice canceled, the open series stays
+        return
       self.fsource = 'dir'
-      self._load_files(filenames)
+      if filenames is None:
+        self.statusBar().showMessage('Scanning Folder')
+        filenames = self.ctx.loader.scan(dir)
+        self.statusBar().showMessage('READY')
+      if filenames:
+        close_archives()
+        self._load_files(filenames)
+      else:
+        self.no_dicoms_message()
+
+  def read_dicomdir(self, dir):
+    # files of the series chosen from the DICOMDIR in dir, False when the
+    # choice was canceled. None when there is no usable DICOMDIR.
+    path = find_dicomdir(dir)
+    if path is None:
+      return None
+    self.statusBar().showMessage('Reading DICOMDIR')
+    try:
+      series = read_dicomdir(path)
+    except Exception:
+      series = []
+    self.statusBar().showMessage('READY')
+    if not series:
+      return None
+    if len(series) == 1:
+      return series[0].fnames
+    selector = SeriesSelector(series, parent=self)
+    return selector.selected().fnames if selector.exec() else False
 
   def on_open_files(self):
     filenames, _ = QFileDialog.getOpenFileNames(self,"Open Files", "", "All Files (*);;DICOM Files (*.dcm)")
     if filenames:
+      close_archives()
       self.fsource = 'files'
       self._load_files(filenames)
 
+  def on_open_archive(self):
+    filename, _ = QFileDialog.getOpenFileName(self,"Open Archive", "", "Archives (*.zip *.tar *.tar.gz *.tgz *.tar.bz2 *.tar.xz);;All Files (*)")
+    if filename:
+      close_archives()
+      self.statusBar().showMessage('Scanning Archive')
+      try:
+        filenames = self.ctx.loader.scan_archive(filename)
+      except Exception as e:
+        self.statusBar().showMessage('READY')
+        QMessageBox.warning(None, "Archive Error", f"Cannot read the archive.\n{e}")
+        return
+      self.statusBar().showMessage('READY')
+      self.fsource = 'archive'
+      self._load_files(filenames)
+
   def on_open_sample(self):
+    close_archives()
     filenames = [os.path.join(self.ctx.sample_dir, f) for f in os.listdir(self.ctx.sample_dir) if os.path.isfile(os.path.join(self.ctx.sample_dir, f))]
     if filenames:
       self.fsource = 'sample'
@@ -315,55 +384,59 @@ class MainWindow(QMainWindow):
     else:
       QMessageBox.information(None, "Info", "No DICOM files in sample directory.")
 
-  def filter_invalid(self, ds):
-    discarded_count = 0
-    valid = []
-    for d in ds:
-      try:
-        type(d.pixel_array)
-        valid.append(d)
-      except:
-        discarded_count+=1
-    return valid, discarded_count
-
   def _load_files(self, fnames):
     # if self.ctx.isImage:
     self.on_close_image()
     self.statusBar().showMessage('Loading Images')
-    n = len(fnames)
-    progress = QProgressDialog(f"Loading {n} images...", "Cancel", 0, n, self)
-    progress.setWindowModality(Qt.WindowModal)
-    progress.setMinimumDuration(1000) # operation shorter than 1 sec will not open progress dialog
-    files = []
-    for idx, filename in enumerate(fnames):
-      dcm = get_dicom(filename)
-      files.append(dcm)
-      progress.setValue(idx)
-      if progress.wasCanceled():
-        break
-    progress.setValue(n)
-
-    if not files:
-      progress.cancel()
-      if self.fsource=='dir':
-        QMessageBox.information(None, "Info", "No DICOM files in the selected directory.")
-      elif self.fsource=='sample':
-        QMessageBox.information(None, "Info", "No DICOM files in sample directory.")
-      elif self.fsource=='files':
-        QMessageBox.warning(None, "Info", "The specified file is not a valid DICOM file.")
+    key = self.ctx.series_key(fnames)
+    cached = self.ctx.series_cache.load(key) if key else None
+    dup = 0
+    if cached is not None:
+      dicoms, self.ctx.volume, dc = cached
+    elif self.ctx.config_value('stream_load', True):
+      self.start_stream(fnames, key)
+      return
+    else:
+      dicoms, dc, dup, canceled = self.read_headers(fnames)
+      if canceled: # do not cache a partial series
+        key = None
+      groups = group_series(dicoms)
+      if len(groups) > 1:
+        selector = SeriesSelector(groups, parent=self)
+        if not selector.exec():
+          self.statusBar().showMessage('READY')
+          return
+        dicoms = selector.selected()
+        key = key and self.ctx.series_key([dcm.filename for dcm in dicoms])
+        cached = self.ctx.series_cache.load(key) if key else None
+        if cached is not None:
+          dicoms, self.ctx.volume, _ = cached
+
+    if not dicoms:
+      self.no_dicoms_message()
       return
 
     self.ctx.isImage = True
-    self.ctx.dicoms, dc = self.filter_invalid(files)
+    self.ctx.dicoms = dicoms
+    self.ctx.header_table = HeaderTable(dicoms)
     if dc>0:
-      f = 'files' if dc>1 else 'file'
-      QMessageBox.warning(None, "Unsupported format", f"Cannot load {dc} {f}.")
+      self.discarded_message(dc)
+    if cached is None and (key or self.ctx.config_value('use_volume', False)):
+      self.build_volume(key, dc)
+    if not self.show_series():
+      self.statusBar().showMessage('READY')
+      return
+    self.set_series_ready(True)
+    self.ready_message(dup)
 
+  def show_series(self):
+    # returns False when none of the slices could be displayed
     self.ctx.total_img = len(self.ctx.dicoms)
     self.total_lbl.setText(str(self.ctx.total_img))
     self.ctx.current_img = 1
-    self.update_image()
-    self.ctx.app_data.emit_img_loaded(True)
+    if not self.update_image():
+      return False
+    self.ctx.prefetch(1)
 
     self.go_to_slice_sb.setValue(self.ctx.current_img)
     self.go_to_slice_sb.setMinimum(self.ctx.current_img)
@@ -377,38 +450,195 @@ class MainWindow(QMainWindow):
     self.dcmtree_btn.setEnabled(True)
     self.close_img_btn.setEnabled(True)
     self.windowing_cb.setEnabled(True)
-    self.sort_btn.setEnabled(True)
     self.adjust_slices()
+    return True
+
+  def set_series_ready(self, state):
+    self.sort_btn.setEnabled(state)
+    self.export_btn.setEnabled(state)
+    self.lock_calc_buttons(not state)
+    self.ctx.app_data.emit_img_loaded(state)
+
+  def lock_calc_buttons(self, locked):
+    # calculations need the complete series, they stay locked while it loads
+    btns = [self.ctdiv_tab.get_info_btn, self.ctdiv_tab.calc_dcm_btn,
+            self.ctdiv_tab.tcm_btn, self.ctdiv_tab.scn_btn, self.diameter_tab.calculate_btn,
+            self.ssde_tab.calc_btn, self.organ_tab.calc_db_btn]
+    for btn in btns:
+      btn.setEnabled(not locked)
+
+  def ready_message(self, dup=0):
+    if dup:
+      f = 'images' if dup>1 else 'image'
+      self.statusBar().showMessage(f'READY - skipped {dup} duplicate {f}')
+    else:
+      self.statusBar().showMessage('READY')
+
+  def no_dicoms_message(self):
+    if self.fsource=='dir':
+      QMessageBox.information(None, "Info", "No DICOM files in the selected directory.")
+    elif self.fsource=='sample':
+      QMessageBox.information(None, "Info", "No DICOM files in sample directory.")
+    elif self.fsource=='files':
+      QMessageBox.warning(None, "Info", "The specified file is not a valid DICOM file.")
+    elif self.fsource=='archive':
+      QMessageBox.information(None, "Info", "No DICOM files in the selected archive.")
+
+  def discarded_message(self, dc):
+    f = 'files' if dc>1 else 'file'
+    QMessageBox.warning(None, "Unsupported format", f"Cannot load {dc} {f}.")
+
+  def start_stream(self, fnames, key):
+    # shows the first series found as soon as its first image is read, the
+    # rest is appended while the remaining headers are read in the background
+    self.stream = self.ctx.loader.stream(fnames)
+    self.stream_key = key
+    self.stream_series = None
+    self.stream_headers = []
+    self.stream_timer.start()
+
+  def stop_stream(self):
+    self.stream_timer.stop()
+    if self.stream is not None:
+      self.stream.cancel()
+    self.stream = None
+    self.stream_headers = []
+
+  def on_stream_tick(self):
+    headers = self.stream.poll()
+    self.stream_headers += headers
+    if self.stream_series is None and headers:
+      self.stream_series = series_uid(headers[0])
+    new = [ds for ds in headers if series_uid(ds) == self.stream_series]
+    if new and not self.ctx.isImage:
+      self.ctx.isImage = True
+      self.ctx.dicoms = new
+      self.ctx.header_table = HeaderTable(new)
+      if self.show_series():
+        self.set_series_ready(False)
+      else: # none of them could be displayed, the next headers are tried
+        self.ctx.isImage = False
+    elif new:
+      self.ctx.dicoms += new
+      self.ctx.header_table.extend(new)
+      self.ctx.total_img = len(self.ctx.dicoms)
+      self.total_lbl.setText(str(self.ctx.total_img))
+      self.go_to_slice_sb.setMaximum(self.ctx.total_img)
+      self.adjust_slices(reset=False)
+    self.statusBar().showMessage(f'Loading Images ({self.stream.count}/{self.stream.total})')
+    if self.stream.done():
+      self.finish_stream()
+
+  def finish_stream(self):
+    headers, key, dup = self.stream_headers, self.stream_key, self.stream.duplicates
+    dc = self.stream.discarded + self.dropped
+    self.dropped = 0
+    self.stream_timer.stop()
+    self.stream = None
+    self.stream_headers = []
+    self.ready_message(dup)
+    if not headers:
+      self.no_dicoms_message()
+      return
+
+    cached = None
+    groups = group_series(headers)
+    if len(groups) > 1:
+      selector = SeriesSelector(groups, parent=self)
+      dicoms = selector.selected() if selector.exec() else None
+      if dicoms and series_uid(dicoms[0]) != self.stream_series:
+        key = key and self.ctx.series_key([dcm.filename for dcm in dicoms])
+        cached = self.ctx.series_cache.load(key) if key else None
+        self.on_close_image()
+        if cached is not None:
+          dicoms, self.ctx.volume, _ = cached
+        self.ctx.isImage = True
+        self.ctx.dicoms = dicoms
+        self.ctx.header_table = HeaderTable(dicoms)
+        if not self.show_series():
+          return
+      else:
+        key = key and self.ctx.series_key([dcm.filename for dcm in self.ctx.dicoms])
+
+    if not self.ctx.isImage: # no slice of the series could be displayed
+      self.on_close_image()
+      self.discarded_message(dc)
+      return
+    if dc>0:
+      self.discarded_message(dc)
+    if cached is None and (key or self.ctx.config_value('use_volume', False)):
+      self.build_volume(key, dc)
+    self.set_series_ready(True)
+    self.ready_message(dup)
+
+  def read_headers(self, fnames):
+    n = len(fnames)
+    progress = QProgressDialog(f"Loading {n} images...", "Cancel", 0, n, self)
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(1000) # operation shorter than 1 sec will not open progress dialog
+
+    def on_progress(count):
+      progress.setValue(count)
+      return not progress.wasCanceled()
+
+    dicoms, dc, dup = self.ctx.loader.load(fnames, on_progress)
+    canceled = progress.wasCanceled()
+    progress.setValue(n)
+    if not dicoms:
+      progress.cancel()
+    return dicoms, dc, dup, canceled
+
+  def build_volume(self, key=None, discarded=0):
+    n = len(self.ctx.dicoms)
+    progress = QProgressDialog(f"Building volume of {n} images...", "Skip", 0, n, self)
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(1000)
 
-  def adjust_slices(self):
+    def on_progress(count):
+      progress.setValue(count)
+      return not progress.wasCanceled()
+
+    self.statusBar().showMessage('Building Volume')
+    fnames = [dcm.filename for dcm in self.ctx.dicoms]
+    frames = [self.ctx.get_frame(idx) for idx in range(n)]
+    hist = HUHistogram()
+
+    def fill(out):
+      return get_hu_imgs(fnames, out=out, workers=self.ctx.loader.workers, callback=on_progress, frames=frames, hist=hist)
+
+    try:
+      if key:
+        self.ctx.volume = self.ctx.series_cache.store(key, self.ctx.dicoms, fill, discarded, hist)
+      else:
+        tmp = tempfile.mkdtemp(prefix='indosect-')
+        try:
+          self.ctx.volume = HUVolume.create(os.path.join(tmp, 'volume'), self.ctx.dicoms, fill, temporary=True, histogram=hist)
+        finally:
+          if self.ctx.volume is None: # failed or canceled
+            shutil.rmtree(tmp, ignore_errors=True)
+    except (OSError, ValueError) as e:
+      QMessageBox.warning(None, "Volume Error", f"Cannot build image volume, images will be read from files.\n{e}")
+    progress.setValue(n)
+    self.statusBar().showMessage('READY')
+
+  def adjust_slices(self, reset=True):
     slice_sbs = [self.ctdiv_tab.calc_slice1_sb, self.ctdiv_tab.calc_slice2_sb,
                  self.ctdiv_tab.dcm_slice1_sb, self.ctdiv_tab.dcm_slice2_sb,
                  self.diameter_tab.slice1_sb, self.diameter_tab.slice2_sb,
                  self.ssde_tab.slice1_sb, self.ssde_tab.slice2_sb,]
     for slice_sb in slice_sbs:
       slice_sb.setMaximum(self.ctx.total_img)
+      if not reset:
+        continue
       slice_sb.setMinimum(1)
       slice_sb.setValue(self.ctx.current_img)
+    if not reset:
+      return
     self.ctx.app_data.slice1 = self.ctx.current_img
     self.ctx.app_data.slice2 = self.ctx.current_img
 
   def get_patient_info(self):
-    ref = self.ctx.dicoms[0]
-    brand = str(ref.Manufacturer) if 'Manufacturer' in ref else ''
-    model = str(ref.ManufacturerModelName) if 'ManufacturerModelName' in ref else ''
-    scanner = brand + '-' + model
-    self.patient_info = {
-      'id': str(ref.PatientID) if 'PatientID' in ref else None,
-      'name': str(ref.PatientName) if 'PatientName' in ref else None,
-      'sex': str(ref.PatientSex) if 'PatientSex' in ref else None,
-      'age': int(str(ref.PatientAge)[:3]) if 'PatientAge' in ref else None,
-      'protocol': str(ref.BodyPartExamined) if 'BodyPartExamined' in ref else None,
-      'date': str(ref.AcquisitionDate) if 'AcquisitionDate' in ref else None,
-      'brand': brand or None,
-      'model': model or None,
-      'scanner': scanner if scanner!='-' else None,
-      'instn': str(ref.InstitutionName) if 'InstitutionName' in ref else None,
-    }
+    self.patient_info = patient_info(self.ctx.dicoms[0])._asdict()
 
   def next_img(self, step):
     if not self.ctx.total_img:
@@ -420,6 +650,7 @@ class MainWindow(QMainWindow):
     else:
       self.ctx.current_img += step
     self.update_image()
+    self.ctx.prefetch(step)
     self.ctx.app_data.emit_img_changed()
 
   def on_next_img(self):
@@ -429,19 +660,51 @@ class MainWindow(QMainWindow):
     self.next_img(5)
 
   def update_image(self):
+    # slices whose pixels cannot be decoded are dropped from the series on
+    # the way. returns False when no slice is left to display, the series is
+    # closed then unless it is still streaming in.
+    self.image_data = None
+    dropped = 0
+    while self.ctx.total_img:
+      self.image_data = self.ctx.get_current_img()
+      if self.image_data is not None:
+        break
+      self.drop_slice(self.ctx.current_img-1)
+      dropped += 1
+    self.dropped += dropped
+    if self.dropped and self.stream is None: # a stream reports them when it finishes
+      self.discarded_message(self.dropped)
+      self.dropped = 0
+    if self.image_data is None:
+      if self.stream is None:
+        self.on_close_image()
+      return False
     self.current_lbl.setText(str(self.ctx.current_img))
     self.ctx.axes.clearAll()
-    self.image_data = self.ctx.get_current_img()
-    if self.image_data is None:
-      self.on_close_image()
-      return
     self.ctx.axes.imshow(self.image_data)
     if isinstance(self.window_width, int) and isinstance(self.window_level, int):
       window_img = windowing(self.image_data, self.window_width, self.window_level)
       self.ctx.axes.add_alt_view(window_img)
-    self.ctx.img_dims = (int(self.ctx.dicoms[self.ctx.current_img-1].Rows), int(self.ctx.dicoms[self.ctx.current_img-1].Columns))
-    self.ctx.recons_dim = float(self.ctx.dicoms[self.ctx.current_img-1].ReconstructionDiameter)
-    self.dt.set_ds(self.ctx.dicoms[self.ctx.current_img-1])
+    table = self.ctx.header_table
+    idx = self.ctx.current_img-1
+    self.ctx.img_dims = (int(table.rows[idx]), int(table.cols[idx]))
+    self.ctx.recons_dim = float(table.reconst_diameter[idx])
+    if self.dt.isVisible():
+      self.dt.set_ds(self.ctx.get_dataset(self.ctx.current_img-1))
+    return True
+
+  def drop_slice(self, idx):
+    self.ctx.prefetcher.cancel(wait=True)
+    self.ctx.hu_cache.clear() # its keys hold the slice index
+    keep = [i for i in range(self.ctx.total_img) if i != idx]
+    self.ctx.dicoms = [self.ctx.dicoms[i] for i in keep]
+    self.ctx.header_table = self.ctx.header_table.take(keep)
+    self.ctx.total_img = len(self.ctx.dicoms)
+    self.ctx.current_img = max(min(self.ctx.current_img, self.ctx.total_img), 1)
+    self.total_lbl.setText(str(self.ctx.total_img))
+    if self.ctx.total_img:
+      self.go_to_slice_sb.setMaximum(self.ctx.total_img)
+      self.adjust_slices(reset=False)
 
   def prev_img(self, step):
     if not self.ctx.total_img:
@@ -453,6 +716,7 @@ class MainWindow(QMainWindow):
     else:
       self.ctx.current_img -= step
     self.update_image()
+    self.ctx.prefetch(-step)
     self.ctx.app_data.emit_img_changed()
 
   def on_prev_img(self):
@@ -462,25 +726,44 @@ class MainWindow(QMainWindow):
     self.prev_img(5)
 
   def on_sort(self):
-    self.ctx.dicoms, skipcount = reslice(self.ctx.dicoms)
+    order, skipcount = get_slice_order(self.ctx.header_table)
+    _, counts = get_repeated_slices(self.ctx.header_table, order)
+    self.ctx.dicoms = [self.ctx.dicoms[idx] for idx in order]
+    self.ctx.header_table = self.ctx.header_table.take(order)
+    # a prefetch still running would cache its slice under the old index
+    self.ctx.prefetcher.cancel(wait=True)
+    self.ctx.hu_cache.clear()
+    if self.ctx.volume is not None:
+      self.ctx.volume.reorder(order)
     if skipcount>0:
-      QMessageBox.information(None, "Info", f"Skipped {skipcount} files with no SliceLocation.")
+      QMessageBox.information(None, "Info", f"Skipped {skipcount} files with no slice position.")
+    repeated = (counts>1).sum()
+    if repeated>0:
+      QMessageBox.information(None, "Info", f"{repeated} slice positions were scanned more than once (up to {counts.max()} times).")
     self.ctx.total_img = len(self.ctx.dicoms)
     self.total_lbl.setText(str(self.ctx.total_img))
     self.ctx.current_img = 1
     self.update_image()
+    self.ctx.prefetch(1)
 
   def on_go_to_slice(self):
     if self.ctx.current_img:
       self.ctx.current_img = self.go_to_slice_sb.value()
       self.update_image()
+      self.ctx.prefetch(1)
 
   def on_go_to_slice_edit_finish(self):
     if self.go_to_slice_sb.hasFocus():
       self.on_go_to_slice()
       self.go_to_slice_sb.clearFocus()
 
+  def on_close_source(self):
+    self.on_close_image()
+    close_archives()
+
   def on_close_image(self):
+    self.stop_stream()
+    self.lock_calc_buttons(False)
     self.initVar()
     self.windowing_cb.setCurrentIndex(0)
     self._get_windowing_parameters(0)
@@ -494,6 +777,7 @@ class MainWindow(QMainWindow):
     self.ctx.axes.clearAll()
     self.ctx.axes.imshow(self.ctx.app_logo)
     self.dcmtree_btn.setEnabled(False)
+    self.export_btn.setEnabled(False)
     self.close_img_btn.setEnabled(False)
     self.windowing_cb.setEnabled(False)
     self.sort_btn.setEnabled(False)
@@ -533,9 +817,43 @@ class MainWindow(QMainWindow):
     if not self.ctx.isImage:
       QMessageBox.warning(None, "Warning", "Open DICOM files first.")
       return
-    self.dt.set_ds(self.ctx.dicoms[self.ctx.current_img-1])
+    self.dt.set_ds(self.ctx.get_dataset(self.ctx.current_img-1))
     self.dt.show()
 
+  def on_export_anonymized(self):
+    if not self.ctx.isImage:
+      QMessageBox.warning(None, "Warning", "Open DICOM files first.")
+      return
+    out_dir = QFileDialog.getExistingDirectory(self, "Export Anonymized Images", "")
+    if not out_dir:
+      return
+    if os.listdir(out_dir):
+      reply = QMessageBox.question(self, "Export Anonymized Images",
+        "The folder is not empty, files with the same names will be overwritten.\nContinue?",
+        QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+      if reply != QMessageBox.Yes:
+        return
+    fnames = list(dict.fromkeys(dcm.filename for dcm in self.ctx.dicoms))
+    n = len(fnames)
+    progress = QProgressDialog(f"Exporting {n} files...", "Abort", 0, n, self)
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(1000)
+
+    def on_progress(count):
+      progress.setValue(count)
+      return not progress.wasCanceled()
+
+    self.statusBar().showMessage('Exporting Images')
+    profile = get_profile(self.ctx.config_value('deid_profile'))
+    written, failed = export_series(self.ctx.loader.threads, fnames, out_dir, profile,
+                                    ahead=2*self.ctx.loader.workers, callback=on_progress)
+    progress.setValue(n)
+    self.statusBar().showMessage('READY')
+    if failed:
+      QMessageBox.warning(None, "Export", f"{written} files exported, {failed} files could not be exported.")
+    else:
+      QMessageBox.information(None, "Export", f"{written} files exported.")
+
   def on_phantom_update(self, idx):
     self.ctx.phantom = self.ctx.phantom_model.record(idx).value("id")
     self.ctx.phantom_name = self.ctx.phantom_model.record(idx).value("name")
@@ -552,9 +870,11 @@ class MainWindow(QMainWindow):
     self.rec_viewer.show()
 
   def on_open_config(self):
+    self.configs.update_cache_usage()
     accepted = self.configs.exec()
     if accepted:
       self.ctx.database.update_connection('patient', self.ctx.patients_database())
+      self.ctx.update_perf_config()
       try:
         self.rec_viewer.on_refresh()
       except:
@@ -626,6 +946,12 @@ class MainWindow(QMainWindow):
     # self.analyze_tab.reset_fields()
 
   def closeEvent(self, event):
+    self.stop_stream()
+    close_archives()
+    self.ctx.prefetcher.shutdown()
+    self.ctx.loader.shutdown()
+    if self.ctx.volume is not None:
+      self.ctx.volume.close()
     self.dt.close() if self.dt.isVisible() else None
     try:
       self.rec_viewer.close() if self.rec_viewer.isVisible() else None
@@ -643,6 +969,10 @@ class AppContext(ApplicationContext):
     check = self.checkFiles()
     if not check:
       return
+    self.hu_cache = HUCache(self.config_value('hu_cache_mb', DEFAULT_CACHE_MB))
+    self.volume = None
+    self.prefetcher = Prefetcher(self._prefetch_img, self.config_value('prefetch_slices', DEFAULT_PREFETCH))
+    self.series_cache = SeriesCache(self.cache_dir(), self.config_value('disk_cache_mb', DEFAULT_DISK_CACHE_MB))
     self.initVar()
     self.database = Database(deff=self.aapm_db, ctdi=self.ctdi_db, ssde=self.ssde_db, patient=self.patients_database(), windowing=self.windowing_db)
     self.phantom_model = QSqlTableModel(db=self.database.ssde_db)
@@ -657,23 +987,136 @@ class AppContext(ApplicationContext):
     self.phantom = HEAD
     self.phantom_name = "HEAD"
     self.records_count = get_records_num(self.patients_database(), 'PATIENTS')
+    self.loader = DicomLoader(self.config_value('loader_workers', default_workers()))
     self.main_window.show()
     return self.app.exec_()
 
   def initVar(self):
     self.dicoms = []
-    self.images = []
+    self.header_table = None
     self.img_dims = (0,0)
     self.recons_dim = 0
     self.current_img = 0
     self.total_img = 0
     self.isImage = False
+    self.prefetcher.cancel(wait=True)
+    self.hu_cache.clear()
+    self.hu_histogram = HUHistogram()
+    if self.volume is not None:
+      self.volume.close()
+    self.volume = None
 
   def get_current_img(self):
-    return get_hu_img(self.dicoms[self.current_img-1])
+    return self.get_img(self.current_img-1)
+
+  def get_img(self, idx):
+    if self.volume is not None:
+      return self.volume[idx]
+    key = self._img_key(idx)
+    img = self.hu_cache.get(key)
+    if img is None:
+      img = self.hu_cache.put(key, self._decode(self.dicoms[idx]))
+    return img
+
+  def iter_imgs(self, idxs):
+    if self.volume is not None:
+      yield from (self.volume[idx] for idx in idxs)
+      return
+    missing = [idx for idx in idxs if self.get_frame(idx) is None and self._img_key(idx) not in self.hu_cache]
+    decoded = self.loader.decode([self.dicoms[idx].filename for idx in missing])
+    missing = set(missing)
+    # multi-frame files are decoded once for all of their frames asked for,
+    # and let go after the last one
+    missing_frames = [pos for pos, idx in enumerate(idxs)
+                      if self.get_frame(idx) is not None and self._img_key(idx) not in self.hu_cache]
+    last_frame = {self.dicoms[idxs[pos]].filename: pos for pos in missing_frames}
+    missing_frames = set(missing_frames)
+    frames = {}
+    for pos, idx in enumerate(idxs):
+      record = self.dicoms[idx]
+      if idx in missing:
+        img = next(decoded)
+      elif pos in missing_frames:
+        if record.filename not in frames:
+          frames[record.filename] = decode_frames(record.filename)
+        hu = frames[record.filename]
+        img = None if hu is None else hu[record.frame].copy()
+        if last_frame[record.filename] == pos:
+          del frames[record.filename]
+      else:
+        yield self.get_img(idx)
+        continue
+      self.hu_histogram.add(record.source, img)
+      yield self.hu_cache.put(self._img_key(idx), img)
+
+  def prefetch(self, step):
+    if self.volume is not None or not self.total_img:
+      return
+    idxs = self.prefetcher.neighbours(self.current_img-1, step, self.total_img)
+    jobs = {}
+    for idx in idxs:
+      jobs.setdefault(self._img_key(idx), (self._img_key(idx), self.dicoms[idx]))
+    self.prefetcher.schedule(list(jobs.values()))
+
+  def _prefetch_img(self, key, record):
+    if key not in self.hu_cache:
+      self.hu_cache.put(key, self._decode(record))
+
+  def _decode(self, record):
+    # frames of a multi-frame file are decoded and cached one at a time
+    img = record.hu()
+    self.hu_histogram.add(record.source, img)
+    return img
 
-  def get_img_from_ds(self, ds):
-    return get_hu_img(ds)
+  @property
+  def histogram(self):
+    # HU histogram of the open series. with a volume it covers the whole
+    # series (volumes cached by older versions are counted once here),
+    # otherwise only the slices decoded so far (see histogram_complete).
+    if self.volume is None:
+      return self.hu_histogram
+    if self.volume.histogram is None:
+      self.volume.histogram = HUHistogram.from_volume(self.volume)
+    return self.volume.histogram
+
+  @property
+  def histogram_complete(self):
+    # whether the histogram counts every slice of the series. without a
+    # volume it only counts the slices decoded so far, see histogram.slices
+    # against total_img for how far it got.
+    if self.volume is not None:
+      return True
+    return bool(self.total_img) and self.hu_histogram.slices >= self.total_img
+
+  def series_key(self, fnames):
+    if not self.series_cache.enabled:
+      return None
+    try:
+      return self.series_cache.fingerprint(fnames)
+    except OSError:
+      return None
+
+  def _img_key(self, idx):
+    if self.get_frame(idx) is not None:
+      return ('frame', self.dicoms[idx].filename, self.get_frame(idx))
+    return (idx, self.dicoms[idx].get('SOPInstanceUID'))
+
+  def get_frame(self, idx):
+    # frame number of slice idx in its multi-frame file, None for single frame files
+    return getattr(self.dicoms[idx], 'frame', None)
+
+  def get_dataset(self, idx):
+    return self.dicoms[idx].dataset()
+
+  def update_perf_config(self):
+    workers = self.config_value('loader_workers', default_workers())
+    if workers != self.loader.workers:
+      self.loader.shutdown()
+      self.loader = DicomLoader(workers)
+    self.hu_cache.set_budget(self.config_value('hu_cache_mb', DEFAULT_CACHE_MB))
+    self.prefetcher.depth = self.config_value('prefetch_slices', DEFAULT_PREFETCH)
+    self.series_cache.max_bytes = int(self.config_value('disk_cache_mb', DEFAULT_DISK_CACHE_MB) * 2**20)
+    self.series_cache.evict()
 
   def checkFiles(self):
     if not os.path.isfile(self.config_file()):
@@ -807,12 +1250,22 @@ class AppContext(ApplicationContext):
   def app_data_dir(self):
     return os.path.join(os.path.expanduser('~'), 'Documents', 'IndoseCT')
 
+  def cache_dir(self):
+    return os.path.join(self.app_data_dir(), 'cache')
+
   def patients_database(self):
     with open(self.config_file(), 'r') as f:
       js = json.load(f)
       path = js['patients_db']
     return path
 
+  def config_value(self, key, default=None):
+    try:
+      with open(self.config_file(), 'r') as f:
+        return json.load(f).get(key, default)
+    except:
+      return default
+
 class AppData(QObject):
   modeValueChanged = pyqtSignal(object)
   diameterValueChanged = pyqtSignal(object)
@@ -954,6 +1407,7 @@ class AppData(QObject):
 
 
 if __name__ == "__main__":
+  multiprocessing.freeze_support()
   appctxt = AppContext()
   fnt = appctxt.app.font()
   fnt.setPointSize(10.5)
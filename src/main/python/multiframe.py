@@ -0,0 +1,109 @@
+import numpy as np
+from pydicom.dataelem import DataElement
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+
+FG_SEQUENCES = ['SharedFunctionalGroupsSequence', 'PerFrameFunctionalGroupsSequence']
+
+# values an enhanced (multi-frame) image keeps in its functional groups, as
+# (macro sequence, attribute in the macro, attribute of a single frame image)
+FRAME_VALUES = [
+  ('PlanePositionSequence', 'ImagePositionPatient', 'ImagePositionPatient'),
+  ('PlaneOrientationSequence', 'ImageOrientationPatient', 'ImageOrientationPatient'),
+  ('PixelMeasuresSequence', 'PixelSpacing', 'PixelSpacing'),
+  ('PixelMeasuresSequence', 'SliceThickness', 'SliceThickness'),
+  ('PixelValueTransformationSequence', 'RescaleIntercept', 'RescaleIntercept'),
+  ('PixelValueTransformationSequence', 'RescaleSlope', 'RescaleSlope'),
+  ('CTExposureSequence', 'CTDIvol', 'CTDIvol'),
+  ('CTExposureSequence', 'XRayTubeCurrentInmA', 'XRayTubeCurrent'),
+  ('CTExposureSequence', 'ExposureTimeInms', 'ExposureTime'),
+  ('CTXRayDetailsSequence', 'KVP', 'KVP'),
+  ('CTReconstructionSequence', 'ReconstructionDiameter', 'ReconstructionDiameter'),
+  ('CTTableDynamicsSequence', 'SpiralPitchFactor', 'SpiralPitchFactor'),
+  ('CTAcquisitionDetailsSequence', 'TotalCollimationWidth', 'TotalCollimationWidth'),
+]
+
+
+def is_multiframe(ds):
+  try:
+    return int(ds.get('NumberOfFrames') or 1) > 1
+  except (TypeError, ValueError):
+    return False
+
+def is_enhanced(ds):
+  # enhanced images keep their per-frame values in functional groups, also
+  # when they hold a single frame
+  return any(seq in ds for seq in FG_SEQUENCES)
+
+def first_item(ds, keyword):
+  seq = ds.get(keyword) if ds is not None else None
+  return seq[0] if seq else None
+
+def frame_groups(ds):
+  # functional group items of each frame, shared group first so the per-frame
+  # values take precedence
+  shared = first_item(ds, 'SharedFunctionalGroupsSequence')
+  per_frame = ds.get('PerFrameFunctionalGroupsSequence') or []
+  groups = []
+  for idx in range(int(ds.get('NumberOfFrames') or 1)):
+    items = [shared, per_frame[idx] if idx < len(per_frame) else None]
+    groups.append([item for item in items if item is not None])
+  return groups
+
+def frame_element(groups, seq, attr):
+  elem = None
+  for group in groups:
+    item = first_item(group, seq)
+    if item is not None and attr in item:
+      elem = item[attr]
+  return elem
+
+def frame_rescale(ds):
+  # per-frame (slopes, intercepts), falling back to the top-level values
+  groups = frame_groups(ds)
+  slopes = np.full(len(groups), float(ds.get('RescaleSlope', 1)))
+  intercepts = np.full(len(groups), float(ds.get('RescaleIntercept', 0)))
+  for idx, group in enumerate(groups):
+    slope = frame_element(group, 'PixelValueTransformationSequence', 'RescaleSlope')
+    intercept = frame_element(group, 'PixelValueTransformationSequence', 'RescaleIntercept')
+    if slope is not None:
+      slopes[idx] = float(slope.value)
+    if intercept is not None:
+      intercepts[idx] = float(intercept.value)
+  return slopes, intercepts
+
+def split_frames(ds):
+  # one header per frame, shaped like a single frame image so the rest of
+  # the application can treat frames as slices. each header keeps the file
+  # name and the frame number, pixel data is never copied here.
+  base = [elem for elem in ds if elem.keyword not in FG_SEQUENCES + ['NumberOfFrames', 'PixelData']]
+  frames = []
+  for idx, groups in enumerate(frame_groups(ds)):
+    fr = Dataset()
+    for elem in base:
+      fr.add(elem)
+    for seq, attr, keyword in FRAME_VALUES:
+      elem = frame_element(groups, seq, attr)
+      if elem is not None:
+        fr.add(DataElement(tag_for_keyword(keyword), elem.VR, elem.value))
+    acq = frame_element(groups, 'FrameContentSequence', 'FrameAcquisitionDateTime')
+    if acq is not None and len(str(acq.value)) > 8:
+      fr.AcquisitionTime = str(acq.value)[8:].split('+')[0].split('-')[0]
+    fr.InstanceNumber = idx + 1
+    location = get_slice_location(fr)
+    if location is not None:
+      fr.add(DataElement(tag_for_keyword('SliceLocation'), 'FD', location))
+    fr.file_meta = ds.file_meta
+    fr.filename = ds.filename
+    fr.frame = idx
+    frames.append(fr)
+  return frames
+
+def get_slice_location(ds):
+  # position along the slice normal, enhanced images have no SliceLocation
+  try:
+    pos = np.array(ds.ImagePositionPatient, dtype=float)
+    iop = np.array(ds.ImageOrientationPatient, dtype=float)
+  except (AttributeError, TypeError, ValueError):
+    return None
+  return float(pos @ np.cross(iop[:3], iop[3:]))
@@ -0,0 +1,357 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_CACHE_MB = 512
+DEFAULT_PREFETCH = 8
+
+
+class HeaderTable:
+  # per-series header values in numpy columns, one row per slice, NaN where
+  # a value is missing
+  columns = {
+    'slice_location': 'SliceLocation',
+    'instance_number': 'InstanceNumber',
+    'slice_thickness': 'SliceThickness',
+    'rows': 'Rows',
+    'cols': 'Columns',
+    'reconst_diameter': 'ReconstructionDiameter',
+    'tube_current': 'XRayTubeCurrent',
+    'exposure_time': 'ExposureTime',
+    'ctdi_vol': 'CTDIvol',
+  }
+  fields = ['position', 'orientation', 'acquisition_time'] + list(columns)
+
+  def __init__(self, dicoms=()):
+    n = len(dicoms)
+    self.position = np.full((n, 3), np.nan)
+    self.orientation = np.full((n, 6), np.nan)
+    self.acquisition_time = np.full(n, np.nan)
+    for field in self.columns:
+      setattr(self, field, np.full(n, np.nan))
+    for idx, ds in enumerate(dicoms):
+      self.position[idx] = to_floats(ds.get('ImagePositionPatient'), 3)
+      self.orientation[idx] = to_floats(ds.get('ImageOrientationPatient'), 6)
+      self.acquisition_time[idx] = parse_time(ds.get('AcquisitionTime'))
+      for field, tag in self.columns.items():
+        getattr(self, field)[idx] = to_float(ds.get(tag))
+
+  def __len__(self):
+    return len(self.slice_location)
+
+  def has(self, *fields):
+    # rows where every one of the scalar fields has a value
+    return ~np.any([np.isnan(getattr(self, field)) for field in fields], axis=0)
+
+  def extend(self, dicoms):
+    other = HeaderTable(dicoms)
+    for field in self.fields:
+      setattr(self, field, np.concatenate([getattr(self, field), getattr(other, field)]))
+
+  def take(self, order):
+    table = HeaderTable()
+    for field in self.fields:
+      setattr(table, field, getattr(self, field)[order])
+    return table
+
+  def slice_positions(self):
+    # position along the slice normal, falls back to SliceLocation when the
+    # patient position is not available for every slice
+    normals = np.cross(self.orientation[:, :3], self.orientation[:, 3:])
+    valid = ~np.isnan(normals).any(axis=1)
+    if valid.any():
+      normals[~valid] = normals[valid][0]
+    pos = np.einsum('ij,ij->i', self.position, normals)
+    if np.isnan(pos).any() and not np.isnan(self.slice_location).any():
+      return self.slice_location.copy()
+    return pos
+
+
+def to_float(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return np.nan
+
+def to_floats(values, n):
+  try:
+    values = [float(v) for v in values]
+  except (TypeError, ValueError):
+    return [np.nan]*n
+  return values if len(values) == n else [np.nan]*n
+
+def parse_time(value):
+  # DICOM TM (HHMMSS.FFFFFF, older files may use HH:MM:SS) to seconds
+  if not value:
+    return np.nan
+  value = str(value).replace(':', '').strip()
+  try:
+    hh = int(value[0:2])
+    mm = int(value[2:4] or 0)
+    ss = float(value[4:] or 0)
+  except ValueError:
+    return np.nan
+  return hh*3600 + mm*60 + ss
+
+
+class HUCache:
+  # LRU cache of decoded HU slices bounded by a memory budget in MB
+  def __init__(self, budget_mb=DEFAULT_CACHE_MB):
+    self.budget = int(budget_mb * 2**20)
+    self.nbytes = 0
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def __len__(self):
+    return len(self._items)
+
+  def get(self, key):
+    with self._lock:
+      img = self._items.get(key)
+      if img is not None:
+        self._items.move_to_end(key)
+      return img
+
+  def put(self, key, img):
+    if img is None or img.nbytes > self.budget:
+      return img
+    img.flags.writeable = False
+    with self._lock:
+      old = self._items.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes
+      self._items[key] = img
+      self.nbytes += img.nbytes
+      self._evict()
+    return img
+
+  def set_budget(self, budget_mb):
+    with self._lock:
+      self.budget = int(budget_mb * 2**20)
+      self._evict()
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self.nbytes = 0
+
+  def _evict(self):
+    while self.nbytes > self.budget and self._items:
+      _, img = self._items.popitem(last=False)
+      self.nbytes -= img.nbytes
+
+
+class HUHistogram:
+  # counts of every int16 HU value over the slices of a series, added up as
+  # the slices are decoded. each source (file) is counted once, so slices
+  # decoded again after leaving the cache do not change the counts. slices
+  # is the number of sources counted.
+  offset = 2**15
+
+  def __init__(self, counts=None, slices=0):
+    self.counts = np.zeros(2**16, dtype=np.int64) if counts is None else counts
+    self.slices = slices
+    self._sources = set()
+    self._cumsum = None
+    self._lock = threading.Lock()
+
+  def add(self, source, img):
+    if img is None or source in self._sources:
+      return
+    counts = np.bincount(img.astype(np.int32).ravel() + self.offset, minlength=2**16)
+    with self._lock:
+      if source in self._sources:
+        return
+      self._sources.add(source)
+      self.slices += 1
+      self.counts += counts
+      self._cumsum = None
+
+  def total(self):
+    return int(self.counts.sum())
+
+  def percentile(self, q):
+    # lowest HU value with at least q percent of the pixels at or below it,
+    # q may be a number or a sequence. None before any slice is added.
+    with self._lock:
+      if self._cumsum is None:
+        self._cumsum = np.cumsum(self.counts)
+      cumsum = self._cumsum
+    if not cumsum[-1]:
+      return None
+    targets = np.maximum(np.ceil(np.asarray(q, dtype=float) / 100 * cumsum[-1]), 1)
+    values = np.searchsorted(cumsum, targets) - self.offset
+    return values.tolist()
+
+  def mode(self):
+    return int(np.argmax(self.counts)) - self.offset if self.total() else None
+
+  def mean(self):
+    total = self.total()
+    if not total:
+      return None
+    return float(np.dot(self.counts, np.arange(2**16) - self.offset) / total)
+
+  def value_range(self):
+    nonzero = np.flatnonzero(self.counts)
+    if not nonzero.size:
+      return None
+    return int(nonzero[0]) - self.offset, int(nonzero[-1]) - self.offset
+
+  def to_dict(self):
+    # counts between the lowest and highest value, for the volume sidecar
+    nonzero = np.flatnonzero(self.counts)
+    if not nonzero.size:
+      return {'start': 0, 'counts': [], 'slices': self.slices}
+    lo, hi = nonzero[0], nonzero[-1]
+    return {'start': int(lo) - self.offset, 'counts': self.counts[lo:hi+1].tolist(), 'slices': self.slices}
+
+  @classmethod
+  def from_dict(cls, d):
+    counts = np.zeros(2**16, dtype=np.int64)
+    lo = d['start'] + cls.offset
+    counts[lo:lo+len(d['counts'])] = d['counts']
+    return cls(counts, d.get('slices', 0))
+
+  @classmethod
+  def from_volume(cls, volume):
+    hist = cls()
+    for idx in range(len(volume)):
+      hist.add(idx, volume[idx])
+    return hist
+
+
+class Prefetcher:
+  # runs fetch(*job) for the scheduled jobs in a worker thread, a new
+  # schedule supersedes the jobs left from the previous one
+  def __init__(self, fetch, depth=DEFAULT_PREFETCH):
+    self.fetch = fetch
+    self.depth = depth
+    self._generation = 0
+    self._executor = ThreadPoolExecutor(max_workers=1)
+
+  def neighbours(self, idx, step, total):
+    # slices ahead in the scrolling direction first, then the ones behind
+    if total < 2 or self.depth <= 0:
+      return []
+    ahead = [(idx + step*k) % total for k in range(1, self.depth+1)]
+    behind = [(idx - step*k) % total for k in range(1, self.depth+1)]
+    idxs = []
+    for i in ahead + behind:
+      if i != idx and i not in idxs:
+        idxs.append(i)
+    return idxs
+
+  def schedule(self, jobs):
+    self._generation += 1
+    if jobs:
+      self._executor.submit(self._run, self._generation, jobs)
+
+  def cancel(self, wait=False):
+    # with wait, also waits for the job being fetched to finish, so nothing
+    # from the old schedule lands in state that is reset next
+    self._generation += 1
+    if wait:
+      try:
+        self._executor.submit(int).result()
+      except RuntimeError: # shut down
+        pass
+
+  def shutdown(self):
+    self.cancel()
+    self._executor.shutdown(wait=False)
+
+  def _run(self, generation, jobs):
+    for job in jobs:
+      if generation != self._generation:
+        return
+      try:
+        self.fetch(*job)
+      except Exception:
+        pass
+
+
+class HUVolume:
+  # int16 HU volume in a .npy file opened as a read-only memory map, with a
+  # JSON sidecar describing the slices it was built from
+  def __init__(self, path, temporary=False):
+    self.path = path
+    self.temporary = temporary
+    with open(path + '.json', 'r') as f:
+      self.meta = json.load(f)
+    self.data = np.load(path + '.npy', mmap_mode='r')
+    self.order = np.arange(self.data.shape[0])
+    hist = self.meta.get('histogram')
+    self.histogram = HUHistogram.from_dict(hist) if hist is not None else None
+
+  def __len__(self):
+    return len(self.order)
+
+  def __getitem__(self, idx):
+    return self.data[self.order[idx]]
+
+  def reorder(self, order):
+    self.order = self.order[order]
+
+  @classmethod
+  def create(cls, path, dicoms, fill, temporary=False, histogram=None):
+    # fill(out) writes the HU slices of dicoms into the memory map and returns
+    # None when canceled. returns None when the build was canceled. the
+    # histogram filled along with the volume is saved with it.
+    ref = dicoms[0]
+    shape = (len(dicoms), int(ref.Rows), int(ref.Columns))
+    data = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.int16, shape=shape)
+    ok = False
+    try:
+      ok = fill(data) is not None
+      data.flush()
+    finally:
+      del data
+      if not ok:
+        remove_volume(path)
+    if not ok:
+      return None
+    meta = {
+      'shape': shape,
+      'spacing': get_spacing(ref),
+      'slope': [float(dcm.RescaleSlope) for dcm in dicoms],
+      'intercept': [float(dcm.RescaleIntercept) for dcm in dicoms],
+      'slice_pos': [float(dcm.SliceLocation) if 'SliceLocation' in dcm else None for dcm in dicoms],
+      'sop_uids': [dcm.get('SOPInstanceUID') for dcm in dicoms],
+      'files': [dcm.filename for dcm in dicoms],
+    }
+    if histogram is not None:
+      meta['histogram'] = histogram.to_dict()
+    with open(path + '.json', 'w') as f:
+      json.dump(meta, f)
+    return cls(path, temporary)
+
+  def close(self):
+    self.data = None
+    if self.temporary:
+      remove_volume(self.path)
+      try:
+        os.rmdir(os.path.dirname(self.path))
+      except OSError:
+        pass
+
+
+def get_spacing(ds):
+  try:
+    return [float(ds.PixelSpacing[0]), float(ds.PixelSpacing[1]), float(ds.SliceThickness)]
+  except:
+    return None
+
+def remove_volume(path):
+  for ext in ('.npy', '.json'):
+    try:
+      os.remove(path + ext)
+    except OSError:
+      pass
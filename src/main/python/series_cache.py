@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import shutil
+
+from archive import source_path
+from series import HUVolume
+from slice_record import SliceRecord
+
+# off by default, a series going into the cache is decoded in full when it
+# is first opened
+DEFAULT_DISK_CACHE_MB = 0
+RECORDS_FORMAT = 2
+
+
+class SeriesCache:
+  # decoded HU volumes and header records of opened series, stored per series
+  # in a directory named after the fingerprint of its files
+  def __init__(self, root, max_mb=DEFAULT_DISK_CACHE_MB):
+    self.root = root
+    self.max_bytes = int(max_mb * 2**20)
+
+  @property
+  def enabled(self):
+    return self.max_bytes > 0
+
+  def fingerprint(self, fnames):
+    h = hashlib.sha1()
+    for fname in sorted({os.path.abspath(f) for f in fnames}):
+      st = os.stat(source_path(fname))
+      h.update(f'{fname}|{st.st_size}|{st.st_mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+  def entry(self, key):
+    return os.path.join(self.root, key)
+
+  def load(self, key):
+    path = self.entry(key)
+    try:
+      with open(os.path.join(path, 'headers.json'), 'r') as f:
+        headers = json.load(f)
+      if headers.get('format') != RECORDS_FORMAT:
+        return None
+      volume = HUVolume(os.path.join(path, 'volume'))
+    except (OSError, ValueError):
+      return None
+    dicoms = [SliceRecord.from_dict(rec) for rec in headers['records']]
+    os.utime(path)
+    return dicoms, volume, headers['discarded']
+
+  def store(self, key, dicoms, fill, discarded=0, histogram=None):
+    # builds the entry next to its final place and moves it in when complete.
+    # returns the cached volume, or None if the build failed or was canceled.
+    path = self.entry(key)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp, exist_ok=True)
+    try:
+      volume = HUVolume.create(os.path.join(tmp, 'volume'), dicoms, fill, histogram=histogram)
+    except:
+      shutil.rmtree(tmp, ignore_errors=True)
+      raise
+    if volume is None:
+      shutil.rmtree(tmp, ignore_errors=True)
+      return None
+    volume.close()
+    headers = {
+      'format': RECORDS_FORMAT,
+      'discarded': discarded,
+      'records': [ds.to_dict() for ds in dicoms],
+    }
+    with open(os.path.join(tmp, 'headers.json'), 'w') as f:
+      json.dump(headers, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    self.evict(keep=key)
+    return HUVolume(os.path.join(path, 'volume'))
+
+  def entries(self):
+    if not os.path.isdir(self.root):
+      return []
+    items = []
+    for entry in os.scandir(self.root):
+      if entry.is_dir() and not entry.name.endswith('.tmp'):
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        items.append((entry.stat().st_mtime, size, entry.name))
+    return sorted(items)
+
+  def size(self):
+    return sum(size for _, size, _ in self.entries())
+
+  def evict(self, keep=None):
+    items = self.entries()
+    total = sum(size for _, size, _ in items)
+    for _, size, key in items:
+      if total <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      shutil.rmtree(self.entry(key), ignore_errors=True)
+      total -= size
+
+  def clear(self):
+    shutil.rmtree(self.root, ignore_errors=True)
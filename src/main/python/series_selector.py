@@ -0,0 +1,52 @@
+from PyQt5.QtWidgets import (QAbstractItemView, QDialog, QDialogButtonBox,
+                             QLabel, QTreeWidget, QTreeWidgetItem, QVBoxLayout)
+
+from dicomdir import SeriesRecord
+
+
+class SeriesSelector(QDialog):
+  def __init__(self, groups, *args, **kwargs):
+    super(SeriesSelector, self).__init__(*args, **kwargs)
+    self.groups = groups
+    self.setWindowTitle('Select Series')
+    self.initUI()
+    self.sigConnect()
+
+  def initUI(self):
+    self.layout = QVBoxLayout()
+    self.tree = QTreeWidget()
+    self.tree.setRootIsDecorated(False)
+    self.tree.setSelectionMode(QAbstractItemView.SingleSelection)
+    self.tree.setHeaderLabels(['Patient', 'Study Date', 'Study', 'Series', 'Description', 'Modality', 'Images'])
+    for group in self.groups:
+      ref = group.info if isinstance(group, SeriesRecord) else group[0]
+      item = QTreeWidgetItem([
+        str(ref.get('PatientName', '')),
+        str(ref.get('StudyDate', '')),
+        str(ref.get('StudyDescription', '')),
+        str(ref.get('SeriesNumber', '')),
+        str(ref.get('SeriesDescription', '')),
+        str(ref.get('Modality', '')),
+        str(len(group)),
+      ])
+      self.tree.addTopLevelItem(item)
+    for col in range(self.tree.columnCount()):
+      self.tree.resizeColumnToContents(col)
+    self.tree.setCurrentItem(self.tree.topLevelItem(0))
+
+    btns = QDialogButtonBox.Open | QDialogButtonBox.Cancel
+    self.buttons = QDialogButtonBox(btns)
+
+    self.layout.addWidget(QLabel(f'{len(self.groups)} series found. Select the series to open:'))
+    self.layout.addWidget(self.tree)
+    self.layout.addWidget(self.buttons)
+    self.setLayout(self.layout)
+    self.resize(720, 320)
+
+  def sigConnect(self):
+    self.buttons.accepted.connect(self.accept)
+    self.buttons.rejected.connect(self.reject)
+    self.tree.itemDoubleClicked.connect(self.accept)
+
+  def selected(self):
+    return self.groups[self.tree.indexOfTopLevelItem(self.tree.currentItem())]
@@ -0,0 +1,87 @@
+from image_processing import get_dicom, get_hu_frame, get_hu_img
+
+# header values kept for every slice of an opened series
+RECORD_TAGS = [
+  'SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID', 'InstanceNumber',
+  'Modality', 'StudyDate', 'StudyDescription', 'SeriesNumber', 'SeriesDescription',
+  'PatientID', 'PatientName', 'PatientSex', 'PatientAge', 'InstitutionName',
+  'Manufacturer', 'ManufacturerModelName', 'BodyPartExamined',
+  'AcquisitionDate', 'AcquisitionTime', 'KVP', 'XRayTubeCurrent',
+  'ExposureTime', 'SpiralPitchFactor', 'TotalCollimationWidth', 'CTDIvol',
+  'SliceLocation', 'SliceThickness', 'ImagePositionPatient',
+  'ImageOrientationPatient', 'PixelSpacing', 'ReconstructionDiameter',
+  'Rows', 'Columns', 'RescaleIntercept', 'RescaleSlope',
+]
+FLOAT_VRS = ('DS', 'FD', 'FL')
+INT_VRS = ('IS', 'US', 'SS', 'UL', 'SL')
+
+
+class SliceRecord:
+  # the header values of one slice as plain python values, with the file
+  # (and frame of a multi-frame file) it came from. the dataset is not kept,
+  # it is read again from the file when needed.
+  __slots__ = ['filename', 'frame'] + RECORD_TAGS
+
+  def __init__(self, filename, frame=None, values=None):
+    self.filename = filename
+    self.frame = frame
+    values = values or {}
+    for tag in RECORD_TAGS:
+      setattr(self, tag, values.get(tag))
+
+  @classmethod
+  def from_dataset(cls, ds):
+    values = {}
+    for tag in RECORD_TAGS:
+      values[tag] = plain_value(ds[tag]) if tag in ds else None
+    return cls(ds.filename, getattr(ds, 'frame', None), values)
+
+  @classmethod
+  def from_dict(cls, rec):
+    values = {tag: tuple(v) if isinstance(v, list) else v for tag, v in rec['header'].items()}
+    return cls(rec['filename'], rec.get('frame'), values)
+
+  def to_dict(self):
+    header = {tag: getattr(self, tag) for tag in RECORD_TAGS if getattr(self, tag) is not None}
+    return {'filename': self.filename, 'frame': self.frame, 'header': header}
+
+  def get(self, tag, default=None):
+    value = getattr(self, tag, None) if tag in RECORD_TAGS else None
+    return default if value is None else value
+
+  def __contains__(self, tag):
+    return self.get(tag) is not None
+
+  @property
+  def source(self):
+    # where the pixels of the slice are, (file, frame or None)
+    return self.filename, self.frame
+
+  def dataset(self):
+    # the whole header of the file, without pixel data
+    return get_dicom(self.filename, stop_before_pixels=True)
+
+  def hu(self):
+    # HU image of the slice, decoded from the file on every call. None when
+    # the file cannot be decoded.
+    try:
+      if self.frame is None:
+        return get_hu_img(get_dicom(self.filename))
+      return get_hu_frame(self.filename, self.frame, self.get('RescaleSlope', 1), self.get('RescaleIntercept', 0))
+    except Exception:
+      return None
+
+
+def plain_value(elem):
+  # element value as str, int or float (a tuple of them for multiple values),
+  # None when empty
+  value = elem.value
+  if value is None or value == '':
+    return None
+  cast = float if elem.VR in FLOAT_VRS else int if elem.VR in INT_VRS else str
+  try:
+    if elem.VM > 1:
+      return tuple(cast(v) for v in value)
+    return cast(value)
+  except (TypeError, ValueError):
+    return None
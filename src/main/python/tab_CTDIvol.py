@@ -460,63 +460,49 @@ class CTDIVolTab(QDialog):
       return
     self.currents = []
     self.idxs = []
-    try:
-      for idx, dcm in enumerate(self.ctx.dicoms):
-        self.currents.append(float(dcm.XRayTubeCurrent))
-        self.idxs.append(idx+1)
-    except Exception as e:
-      self.currents = []
-      self.idxs = []
+    currents = self.ctx.header_table.tube_current
+    if np.isnan(currents).any():
       if not self.disable_warning:
-        QMessageBox.warning(None, 'Exception Occured', str(e))
+        QMessageBox.warning(None, 'Missing Attribute', "The DICOM does not contain the value of XRayTubeCurrent.")
       return
-    tube_current = sum(self.currents)/self.ctx.total_img
+    self.currents = currents.copy()
+    self.idxs = list(range(1, len(currents)+1))
+    tube_current = currents.mean()
     self.tube_current_edit.setText(f'{tube_current:#.2f}')
     self.tube_current = tube_current
     self.plot_tcm()
 
   def get_ctdiv_dicom(self, idx):
-    try:
-      ctdiv = float(self.ctx.dicoms[idx-1].CTDIvol)
-    except:
+    ctdiv = float(self.ctx.header_table.ctdi_vol[idx-1])
+    if np.isnan(ctdiv):
       if not self.disable_warning:
         QMessageBox.warning(None, "Warning", "The DICOM does not contain the value of CTDIvol.\nPlease try different method.")
       ctdiv = 0
     return ctdiv
 
-  def get_ctdiv_dicom_3d(self, idxs, dss):
-    ctdivs = []
-    currents = []
-    to_remove = []
-    for idx, dcm in zip(idxs, dss):
-      if not hasattr(dcm, 'CTDIvol') or not hasattr(dcm, 'XRayTubeCurrent'):
-        to_remove.append(idx)
-        continue
-      ctdivs.append(float(dcm.CTDIvol))
-      currents.append(float(dcm.XRayTubeCurrent))
-
-    if len(to_remove) > 0:
-      [idxs.remove(idx) for idx in to_remove if idx in idxs]
-    self.currents = np.array(currents)
-    self.ctdivs = np.array(ctdivs)
-    return idxs
+  def get_ctdiv_dicom_3d(self, idxs):
+    # keeps the slices that have both CTDIvol and tube current
+    table = self.ctx.header_table
+    idxs = np.asarray(idxs, dtype=int)
+    idxs = idxs[table.has('ctdi_vol', 'tube_current')[idxs]]
+    self.currents = table.tube_current[idxs]
+    self.ctdivs = table.ctdi_vol[idxs]
+    return idxs.tolist()
 
   def get_scan_length_dicom(self):
     if self.method == 0 and not self.ctx.isImage and not self.disable_warning:
       QMessageBox.warning(None, "Warning", "Open DICOM files first, or input manually")
       self.opts.setCurrentIndex(0)
       return
-    try:
-      first = float(self.ctx.dicoms[0].SliceLocation)
-      last = float(self.ctx.dicoms[-1].SliceLocation)
-      width = float(self.ctx.dicoms[0].SliceThickness)
-      try:
-        second = float(self.ctx.dicoms[1].SliceLocation)
-      except:
-        second = last
-    except Exception as e:
+    table = self.ctx.header_table
+    locs = table.slice_location
+    first = locs[0]
+    last = locs[-1]
+    width = table.slice_thickness[0]
+    second = locs[1] if len(locs) > 1 and not np.isnan(locs[1]) else last
+    if np.isnan([first, last, width]).any():
       if not self.disable_warning:
-        QMessageBox.warning(None, 'Exception Occured', str(e))
+        QMessageBox.warning(None, 'Missing Attribute', "The DICOM does not contain the value of SliceLocation or SliceThickness.")
       return
 
     lf = abs(0.1*(last-first))
@@ -540,11 +526,12 @@ class CTDIVolTab(QDialog):
     missing_data = {}
     missing_attr = []
     for attr in attrs:
-      try:
-        kv_pairs[attr] = self.ctx.dicoms[self.ctx.current_img-1][attr].value
-      except KeyError:
+      value = self.ctx.dicoms[self.ctx.current_img-1].get(attr)
+      if value is None:
         kv_pairs[attr] = 0
         missing_attr.append(attr)
+      else:
+        kv_pairs[attr] = value
 
     if kv_pairs[attrs[0]].lower() in self.brand_items:
       brand_id = self.brand_items.index(kv_pairs[attrs[0]].lower())
@@ -757,29 +744,20 @@ class CTDIVolTab(QDialog):
         self.dcm_to_lbl.setHidden(True)
         self.dcm_slice2_sb.setHidden(True)
 
-  def calc_all_slices(self, idxs, dss):
+  def calc_all_slices(self, idxs):
     if not self.ctx.isImage:
       QMessageBox.warning(None, "Warning", "Open DICOM files first.")
       return
-    c = []
-    e = []
-    to_remove = []
-    for idx, dcm in zip(idxs, dss):
-      if not hasattr(dcm, 'XRayTubeCurrent') or not hasattr(dcm, 'ExposureTime'):
-        to_remove.append(idx)
-        continue
-      c.append(float(dcm.XRayTubeCurrent))
-      e.append(float(dcm.ExposureTime)/1000)
-    if len(to_remove)>0:
-      [idxs.remove(idx) for idx in to_remove if idx in idxs]
-
-    currents = np.array(c)
-    exp_time = np.array(e)
+    table = self.ctx.header_table
+    idxs = np.asarray(idxs, dtype=int)
+    idxs = idxs[table.has('tube_current', 'exposure_time')[idxs]]
+
+    currents = table.tube_current[idxs]
+    exp_time = table.exposure_time[idxs]/1000
     mAs = currents*exp_time
     eff_mAs = mAs/self.pitch if self.pitch > 0 else mAs
     ctdiw = self.coll*self.CTDI*mAs / 100
     ctdiv = ctdiw/self.pitch
-      # print(idx+1, currents[idx], exp_time[idx], mAs[idx], eff_mAs[idx], ctdiw[idx], ctdiv[idx], sep='\t')
 
     self.currents = currents
     self.ctdivs = ctdiv
@@ -791,7 +769,7 @@ class CTDIVolTab(QDialog):
     self.eff_mAs = eff_mAs.mean()
     self.CTDIw = ctdiw.mean()
     self.CTDIv = ctdiv.mean()
-    return idxs
+    return idxs.tolist()
 
   def calculate_method(self):
     if not self.all_slices:
@@ -814,28 +792,23 @@ class CTDIVolTab(QDialog):
     else:
       self.idxs = []
       nslice = self.calc_slice1_sb.value()
-      dcms = np.array(self.ctx.dicoms)
-      index = list(range(len(dcms)))
+      index = list(range(len(self.ctx.dicoms)))
       self.ctx.app_data.mode3d = self.calc_3d_method
       self.ctx.app_data.slice1 = nslice
       if self.calc_3d_method  == 'slice step':
         idxs = index[::nslice]
-        imgs = dcms[::nslice]
       elif self.calc_3d_method  == 'slice number':
-        tmps = np.array_split(np.arange(len(dcms)), nslice)
+        tmps = np.array_split(np.arange(len(index)), nslice)
         idxs = [tmp[len(tmp)//2] for tmp in tmps]
-        imgs = dcms[idxs]
       elif self.calc_3d_method  == 'regional':
         nslice2 = self.calc_slice2_sb.value()
         self.ctx.app_data.slice2 = nslice2
         first = nslice if nslice<=nslice2 else nslice2
         last = nslice2 if nslice<=nslice2 else nslice
         idxs = index[first-1:last]
-        imgs = dcms[first-1:last]
       else:
-        imgs = dcms
         idxs = index
-      idxs = self.calc_all_slices(idxs, imgs)
+      idxs = self.calc_all_slices(idxs)
       if idxs is None:
         return
       self.idxs = [i+1 for i in idxs]
@@ -868,9 +841,8 @@ class CTDIVolTab(QDialog):
 
     self.get_scan_length_dicom()
     # curCTDIv = self.get_ctdiv_dicom(self.ctx.current_img)
-    dcms = np.array(self.ctx.dicoms)
-    index = list(range(len(dcms)))
-    index = self.get_ctdiv_dicom_3d(index, dcms)
+    n = len(self.ctx.dicoms)
+    index = self.get_ctdiv_dicom_3d(range(n))
     if self.all_slices_dcm:
       nslice = self.dcm_slice1_sb.value()
       self.ctx.app_data.mode3d = self.dcm_3d_method
@@ -878,7 +850,7 @@ class CTDIVolTab(QDialog):
       if self.dcm_3d_method  == 'slice step':
         idxs = index[::nslice]
       elif self.dcm_3d_method  == 'slice number':
-        tmps = np.array_split(np.arange(len(dcms)), nslice)
+        tmps = np.array_split(np.arange(n), nslice)
         idxs = [tmp[len(tmp)//2] for tmp in tmps]
       elif self.dcm_3d_method  == 'regional':
         nslice2 = self.dcm_slice2_sb.value()
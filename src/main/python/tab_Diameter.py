@@ -1,5 +1,5 @@
 import numpy as np
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QDoubleValidator
 from PyQt5.QtSql import QSqlQueryModel, QSqlTableModel
 from PyQt5.QtWidgets import (QButtonGroup, QCheckBox, QComboBox, QDialog,
@@ -13,7 +13,8 @@ from constants import *
 from image_processing import (get_center, get_center_max, get_correction_mask,
                               get_deff_correction, get_deff_value,
                               get_dw_value, get_img_no_table, get_mask,
-                              get_mask_pos, windowing)
+                              get_mask_pos, get_mask_preview, get_pyramid,
+                              preview_factor, windowing)
 from Plot import PlotDialog
 
 
@@ -60,6 +61,8 @@ class DiameterTab(QDialog):
     self.idxs = []
     self.d_vals = []
     self.show_graph = False
+    self.preview_level = None
+    self.previewing = False
 
   def initModel(self):
     self.query_model = QSqlQueryModel()
@@ -405,6 +408,14 @@ class DiameterTab(QDialog):
     self._dw_img_manual_ui()
     self._deff_correction_ui()
 
+    # threshold and minimum area edits are previewed on a downsampled image,
+    # the timer runs the preview once per event loop pass
+    self.segmentation_sbs = [self.deff_threshold_sb, self.deff_minimum_area_sb,
+                             self.dw_threshold_sb, self.dw_minimum_area_sb]
+    self.preview_timer = QTimer(self)
+    self.preview_timer.setSingleShot(True)
+    self.preview_timer.setInterval(0)
+
     self.opts_stack = QStackedWidget()
     self.opts_stack.addWidget(self.deff_auto_grpbox)
     self.opts_stack.addWidget(self.deff_img_manual_grpbox)
@@ -462,6 +473,8 @@ class DiameterTab(QDialog):
     self.dw_minimum_area_sb.valueChanged.connect(self.on_minimum_area_changed)
     self.deff_threshold_sb.valueChanged.connect(self.on_threshold_changed)
     self.dw_threshold_sb.valueChanged.connect(self.on_threshold_changed)
+    [sb.editingFinished.connect(self.refine_segmentation) for sb in self.segmentation_sbs]
+    self.preview_timer.timeout.connect(self.preview_segmentation)
     self.dw_ellipse_btn.clicked.connect(self.add_ellipse)
     self.dw_polygon_btn.clicked.connect(self.add_polygon)
     self.deff_ap_btn.clicked.connect(self.add_ap_line)
@@ -668,6 +681,7 @@ class DiameterTab(QDialog):
       self.dw_minimum_area_sb.setValue(self.minimum_area)
     else:
       self.deff_minimum_area_sb.setValue(self.minimum_area)
+    self.preview_timer.start()
 
   def on_threshold_changed(self):
     sender = self.sender()
@@ -676,6 +690,7 @@ class DiameterTab(QDialog):
       self.dw_threshold_sb.setValue(self.threshold)
     else:
       self.deff_threshold_sb.setValue(self.threshold)
+    self.preview_timer.start()
 
   def on_bone_limit_changed(self):
     self.bone_limit = self.bone_sb.value()
@@ -684,6 +699,8 @@ class DiameterTab(QDialog):
     self.stissue_limit = self.stissue_sb.value()
 
   def on_calculate(self):
+    self.preview_timer.stop()
+    self.previewing = False
     self.ctx.app_data.d_mode = 0
     if self.source == 0: # from img
       if not self.ctx.isImage:
@@ -737,7 +754,7 @@ class DiameterTab(QDialog):
         if self.is_no_table:
           img_to_show = get_img_no_table(img, threshold=self.threshold)
           img = img_to_show.copy()
-        img[img<-1000] = -1000
+        img = np.maximum(img, -1000)
       else:
         mask = self.get_img_mask(img, threshold=self.threshold, minimum_area=self.minimum_area, largest_only=self.is_largest_only)
         if mask is None:
@@ -758,27 +775,22 @@ class DiameterTab(QDialog):
     self.d_vals = []
     self.idxs = []
     nslice = self.slice1_sb.value()
-    dcms = np.array(self.ctx.dicoms)
-    index = list(range(len(dcms)))
+    index = list(range(self.ctx.total_img))
 
     if self.d_3d_method  == 'slice step':
       idxs = index[::nslice]
-      imgs = dcms[::nslice]
     elif self.d_3d_method  == 'slice number':
-      tmps = np.array_split(np.arange(len(dcms)), nslice)
+      tmps = np.array_split(np.arange(len(index)), nslice)
       idxs = [tmp[len(tmp)//2] for tmp in tmps]
-      imgs = dcms[idxs]
     elif self.d_3d_method  == 'regional':
       nslice2 = self.slice2_sb.value()
       first = nslice if nslice<=nslice2 else nslice2
       last = nslice2 if nslice<=nslice2 else nslice
       idxs = index[first-1:last]
-      imgs = dcms[first-1:last]
     else:
-      imgs = dcms
       idxs = index
 
-    avg_dval, idxs = self.get_avg_diameter(imgs, idxs)
+    avg_dval, idxs = self.get_avg_diameter(idxs)
     self.d_edit.setText(f'{avg_dval:#.2f}')
     self.ctx.app_data.diameter = avg_dval
     self.idxs = [i+1 for i in idxs]
@@ -886,16 +898,17 @@ class DiameterTab(QDialog):
     self.lineLAT = self.lineAP = 0
     self.ctx.app_data.diameter = 0
 
-  def get_avg_diameter(self, dss, idxs):
+  def get_avg_diameter(self, idxs):
     dval = 0
-    n = len(dss)
+    n = len(idxs)
     n_seg = 0
     progress = QProgressDialog(f"Calculating diameter of {n} images...", "Stop", 0, n, self)
     progress.setWindowModality(Qt.WindowModal)
     progress.setMinimumDuration(1000)
-    for idx, dcm in enumerate(dss):
-      img = self.ctx.get_img_from_ds(dcm)
-      if self.baseon == 0:
+    for idx, img in enumerate(self.ctx.iter_imgs(idxs)):
+      if img is None:
+        d = 0
+      elif self.baseon == 0:
         mask = get_mask(img, threshold=self.threshold, minimum_area=self.minimum_area, largest_only=True)
         if mask is not None:
           n_seg += 1
@@ -914,7 +927,7 @@ class DiameterTab(QDialog):
           mask = np.ones_like(img,  dtype=bool)
           if self.is_no_table:
             img = get_img_no_table(img, threshold=self.threshold)
-          img[img<-1000] = -1000
+          img = np.maximum(img, -1000)
         else:
           mask = get_mask(img, threshold=self.threshold, minimum_area=self.minimum_area, largest_only=self.is_largest_only)
         if mask is not None:
@@ -937,11 +950,51 @@ class DiameterTab(QDialog):
       QMessageBox.warning(None, 'Segmentation Failed', 'No object found during segmentation process.')
     return mask
 
-  def plot_mask(self, mask):
-    pos = get_mask_pos(mask)+.5
+  def plot_mask(self, mask, factor=1):
+    # factor is the downsampling of mask, its pixels are drawn at the center
+    # of the blocks they cover
+    pos = get_mask_pos(mask)*factor + factor/2
     pos_col = pos[:,1]
     pos_row = pos[:,0]
-    self.ctx.axes.immarker(pos_col, pos_row, pen=None, symbol='s', symbolPen=None, symbolSize=3, symbolBrush=(255, 0, 0, 255))
+    self.ctx.axes.immarker(pos_col, pos_row, pen=None, symbol='s', symbolPen=None, symbolSize=3*factor, symbolBrush=(255, 0, 0, 255))
+
+  def can_preview(self):
+    return (self.ctx.isImage and self.source == 0 and self.method in (0, 1)
+            and not (self.baseon == 1 and self.is_no_roi))
+
+  def segmentation_opts(self):
+    largest_only = True if self.baseon == 0 else self.is_largest_only
+    return dict(threshold=self.threshold, minimum_area=self.minimum_area, largest_only=largest_only)
+
+  def preview_segmentation(self):
+    # outline of the current image segmented at a pyramid level. the level is
+    # kept with the record of its slice and made again when another record
+    # is shown (other slice, sorted or newly opened series).
+    if not self.can_preview():
+      return
+    record = self.ctx.dicoms[self.ctx.current_img-1]
+    if self.preview_level is None or self.preview_level[0] is not record:
+      img = self.ctx.get_current_img()
+      factor = preview_factor(img.shape)
+      self.preview_level = record, factor, get_pyramid(img)[factor]
+    _, factor, level = self.preview_level
+    mask = get_mask_preview(level, factor, **self.segmentation_opts())
+    self.ctx.axes.clearGraph()
+    if mask is not None:
+      self.plot_mask(mask, factor)
+    self.previewing = True
+
+  def refine_segmentation(self):
+    # the preview is replaced by the full resolution outline once editing is
+    # done, the same segmentation calculate uses
+    self.preview_timer.stop()
+    if not self.previewing or not self.can_preview():
+      return
+    self.previewing = False
+    mask = get_mask(self.ctx.get_current_img(), **self.segmentation_opts())
+    self.ctx.axes.clearGraph()
+    if mask is not None:
+      self.plot_mask(mask)
 
   def plot_ap_lat(self, mask, row, col):
     pos = get_mask_pos(mask)+.5
@@ -971,10 +1024,9 @@ class DiameterTab(QDialog):
     self.figure.show()
 
   def get_distance(self, p1, p2):
-    try:
-      col,row = self.ctx.get_current_img().shape
-    except:
+    if not self.ctx.isImage:
       return
+    col,row = self.ctx.img_dims
     rd = self.ctx.recons_dim
     return np.sqrt(((np.array(p2)-np.array(p1))**2).sum()) * (0.1*(rd/row))
 
@@ -985,7 +1037,7 @@ class DiameterTab(QDialog):
     if not self.ctx.isImage:
       QMessageBox.warning(None, "Warning", "Open DICOM files first.")
       return
-    x, y = self.ctx.get_current_img().shape
+    x, y = self.ctx.img_dims
     self.ctx.axes.addLAT(((x/2)-0.25*x, y/2), ((x/2)+0.25*x, y/2))
     self.ctx.axes.lineLAT.sigRegionChanged.connect(self.get_lat_from_line)
     pts = self.ctx.axes.lineLAT.getHandles()
@@ -999,7 +1051,7 @@ class DiameterTab(QDialog):
     if not self.ctx.isImage:
       QMessageBox.warning(None, "Warning", "Open DICOM files first.")
       return
-    x, y = self.ctx.get_current_img().shape
+    x, y = self.ctx.img_dims
     self.ctx.axes.addAP(((x/2), (y/2)-0.25*y), ((x/2), (y/2)+0.25*y))
     self.ctx.axes.lineAP.sigRegionChanged.connect(self.get_ap_from_line)
     pts = self.ctx.axes.lineAP.getHandles()
@@ -356,16 +356,17 @@ class OrganTab(QWidget):
 
     cancel = False
     rd = self.ctx.recons_dim
-    row, col = self.ctx.get_current_img().shape
-    mask = self.get_img_mask(self.ctx.get_current_img(), largest_only=True)
-    if mask is not None:
-      mask = mask.astype(float)
+    img = self.ctx.get_current_img()
+    row, col = img.shape
+    seg = self.get_img_mask(img, largest_only=True)
+    if seg is None:
+      return
+    mask = seg.mask.astype(float)
     mask_pos = np.argwhere(mask==1)
-    center = get_center(mask)
+    center = get_center(seg)
 
     dist_vec = np.sqrt(((mask_pos-center)**2).sum(1))
     if self.ctx.app_data.mode==DW:
-      img = self.ctx.get_current_img()
       profile_line_vec = np.zeros_like(dist_vec, dtype=float)
       n = mask_pos.shape[0]
       progress = QProgressDialog(f"Building dose map...", "Stop", 0, n, self)
@@ -355,15 +355,14 @@ class SSDETab(QDialog):
     if not self.ctx.isImage:
       self.idxs = [0]
       return
-    dcms = np.array(self.ctx.dicoms)
-    index = list(range(len(dcms)))
+    index = list(range(len(self.ctx.dicoms)))
     idxs = index
     if self.all_slices:
       nslice = self.slice1_sb.value()
       if self.d3_method  == 'slice step':
         idxs = index[::nslice]
       elif self.d3_method  == 'slice number':
-        tmps = np.array_split(np.arange(len(dcms)), nslice)
+        tmps = np.array_split(np.arange(len(index)), nslice)
         idxs = [tmp[len(tmp)//2] for tmp in tmps]
       elif self.d3_method  == 'regional':
         nslice2 = self.slice2_sb.value()
@@ -0,0 +1,151 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'main', 'python'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import pytest
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QApplication, QSpinBox
+
+from image_processing import downsample
+from tab_Diameter import DiameterTab
+
+
+@pytest.fixture(scope='module')
+def app():
+  return QApplication.instance() or QApplication([])
+
+
+class PreviewStub:
+  # the parts of DiameterTab the spin box handlers touch, the preview only
+  # counts how often it runs
+  def __init__(self):
+    self.previews = 0
+    self.sender_sb = None
+    self.deff_threshold_sb, self.dw_threshold_sb = QSpinBox(), QSpinBox()
+    self.deff_minimum_area_sb, self.dw_minimum_area_sb = QSpinBox(), QSpinBox()
+    for sb in (self.deff_threshold_sb, self.dw_threshold_sb):
+      sb.setRange(-32768, 32767)
+    for sb in (self.deff_minimum_area_sb, self.dw_minimum_area_sb):
+      sb.setMaximum(512*512)
+    self.preview_timer = QTimer()
+    self.preview_timer.setSingleShot(True)
+    self.preview_timer.setInterval(0)
+    self.preview_timer.timeout.connect(self.preview_segmentation)
+
+  def sender(self):
+    return self.sender_sb
+
+  def preview_segmentation(self):
+    self.previews += 1
+
+  def edit(self, handler, sb, value):
+    self.sender_sb = sb
+    sb.setValue(value)
+    handler(self)
+
+
+def test_minimum_area_change_previews(app):
+  tab = PreviewStub()
+  tab.edit(DiameterTab.on_minimum_area_changed, tab.dw_minimum_area_sb, 800)
+  assert tab.minimum_area == 800
+  assert tab.deff_minimum_area_sb.value() == 800
+  app.processEvents()
+  assert tab.previews == 1
+
+def test_threshold_change_previews(app):
+  tab = PreviewStub()
+  tab.edit(DiameterTab.on_threshold_changed, tab.deff_threshold_sb, -200)
+  assert tab.threshold == -200
+  assert tab.dw_threshold_sb.value() == -200
+  app.processEvents()
+  assert tab.previews == 1
+
+def test_edits_in_one_pass_preview_once(app):
+  tab = PreviewStub()
+  tab.edit(DiameterTab.on_threshold_changed, tab.dw_threshold_sb, -250)
+  tab.edit(DiameterTab.on_minimum_area_changed, tab.deff_minimum_area_sb, 600)
+  app.processEvents()
+  assert tab.previews == 1
+
+
+class SeriesStub:
+  # slices are disks of different radius, records are plain objects
+  def __init__(self, radii):
+    self.isImage = True
+    self.current_img = 1
+    self.dicoms = [object() for _ in radii]
+    self.imgs = [disk_image(r) for r in radii]
+    self.axes = AxesStub()
+
+  def get_current_img(self):
+    return self.imgs[self.current_img-1]
+
+  def sort(self, order):
+    self.dicoms = [self.dicoms[idx] for idx in order]
+    self.imgs = [self.imgs[idx] for idx in order]
+
+
+class AxesStub:
+  def __init__(self):
+    self.markers = []
+
+  def clearGraph(self):
+    self.markers = []
+
+  def immarker(self, cols, rows, **kwargs):
+    self.markers.append((cols, rows))
+
+
+class SegmentationStub:
+  can_preview = DiameterTab.can_preview
+  segmentation_opts = DiameterTab.segmentation_opts
+  preview_segmentation = DiameterTab.preview_segmentation
+  plot_mask = DiameterTab.plot_mask
+
+  def __init__(self, ctx):
+    self.ctx = ctx
+    self.source = self.method = self.baseon = 0
+    self.is_no_roi = self.is_largest_only = False
+    self.threshold = -300
+    self.minimum_area = 500
+    self.preview_level = None
+    self.previewing = False
+
+
+def disk_image(radius):
+  rows, cols = np.mgrid[:512, :512]
+  img = np.full((512, 512), -1000, dtype=np.int16)
+  img[(rows-240)**2 + (cols-256)**2 < radius**2] = 40
+  return img
+
+def outline_radius(tab):
+  cols, rows = tab.ctx.axes.markers[-1]
+  return np.hypot(rows-240, cols-256).max()
+
+def assert_level_of_current(tab):
+  assert tab.preview_level[0] is tab.ctx.dicoms[tab.ctx.current_img-1]
+  assert np.array_equal(tab.preview_level[2], downsample(tab.ctx.get_current_img(), tab.preview_level[1]))
+
+def test_preview_follows_the_shown_slice():
+  tab = SegmentationStub(SeriesStub([60, 120]))
+  tab.preview_segmentation()
+  assert outline_radius(tab) < 70
+  tab.ctx.current_img = 2 # go to slice, nothing resets the tab
+  tab.preview_segmentation()
+  assert_level_of_current(tab)
+  assert outline_radius(tab) > 110
+
+def test_preview_after_sort_and_new_series():
+  tab = SegmentationStub(SeriesStub([60, 120]))
+  tab.preview_segmentation()
+  tab.ctx.sort([1, 0])
+  tab.preview_segmentation()
+  assert_level_of_current(tab)
+  assert outline_radius(tab) > 110
+  tab.ctx.__init__([90]) # another series opened
+  tab.preview_segmentation()
+  assert_level_of_current(tab)
+  assert 80 < outline_radius(tab) < 100